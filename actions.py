@@ -1,8 +1,11 @@
 
 import re
 import string
+import threading
 import phonenumbers
 from hashlib import sha256
+from collections import Counter
+from cachetools import LRUCache
 
 PREFIX = 'MASKED_'
 MIN_TOKEN_LENGTH = 3
@@ -11,11 +14,23 @@ MIN_TOKEN_LENGTH = 3
 # Regex to match an email address:
 EMAIL_REGEX = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
 ANONYMIZATION_KEY = 'GO3fsF@WEB3DqWh'
+# Number of anonymized tokens kept in memory, 0 disables the cache
+DEF_TOKEN_CACHE_SIZE = 100000
 
+DIGITS_REGEX = re.compile(r'\d+')
+# Characters the phone number matcher may repeat without limit inside a single number (around
+# extensions like "555 1234 , ext 12")
+PHONE_SEPARATORS_REGEX = re.compile(r'[\s,\-:.\uFF0E]')
+# The shortest valid phone number has 6 digits (country code included)
+MIN_PHONE_DIGITS = 6
+# Number of other characters which separate two digits of different phone numbers for sure.
+# Longer than any extension label and the punctuation allowed between the number digits.
+PHONE_WINDOW_GAP = 32
 
-def _anonymize_token(token: str) -> str:
-    """Anonymize Token
-    Receives a token to anonymize (like a name) and returns it's anonymized (hashed) version.
+
+def _hash_token(token: str) -> str:
+    """Hash Token
+    Returns the anonymized (hashed) version of the token.
     Uses ANONYMIZATION_KEY defined in settings.py/env.py files.
     This function is a duplicate from Data Manager.
 
@@ -29,6 +44,336 @@ def _anonymize_token(token: str) -> str:
     return f"{PREFIX}{sha256(string).hexdigest()}"
 
 
+class TokenCache():
+    '''Token Cache
+    Bounded LRU cache of anonymized tokens, shared by all the actions and sources of a run.
+    The same addresses and numbers repeat across tickets and comments, so most of them are
+    hashed only once.
+    '''
+
+    def __init__(self, max_size: int = DEF_TOKEN_CACHE_SIZE) -> None:
+        self._lock = threading.Lock()
+        self.resize(max_size)
+
+    def resize(self, max_size: int):
+        """Resize
+        Replaces the cache with an empty one of the given size, 0 disables caching
+        """
+        with self._lock:
+            self._max_size = max(max_size, 0)
+            self._cache = LRUCache(maxsize=self._max_size) if self._max_size else None
+            self._hits = 0
+            self._misses = 0
+
+    def get(self, token: str) -> str:
+        """Get
+        Returns the anonymized token, hashing it only if it is not cached
+        """
+        with self._lock:
+            if self._cache is not None:
+                anonymized = self._cache.get(token)
+                if anonymized is not None:
+                    self._hits += 1
+                    return anonymized
+            self._misses += 1
+
+        anonymized = _hash_token(token)
+        if self._cache is not None:
+            with self._lock:
+                self._cache[token] = anonymized
+        return anonymized
+
+    def drain_counts(self) -> tuple:
+        """Drain counts
+        Returns the hits and misses counted since the last drain, and resets them
+        """
+        with self._lock:
+            counts = (self._hits, self._misses)
+            self._hits = self._misses = 0
+            return counts
+
+    def add_counts(self, hits: int, misses: int):
+        """Add counts
+        Adds hits and misses counted by another cache, like the one of a worker process
+        """
+        with self._lock:
+            self._hits += hits
+            self._misses += misses
+
+    def stats(self) -> dict:
+        """Stats
+        Returns the cache size and its hit statistics
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {'max_size': self._max_size,
+                    'size': len(self._cache) if self._cache is not None else 0,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_rate': self._hits / lookups if lookups else 0.0}
+
+
+TOKEN_CACHE = TokenCache()
+
+
+def _anonymize_token(token: str) -> str:
+    """Anonymize Token
+    Receives a token to anonymize (like a name) and returns it's anonymized (hashed) version,
+    memoized in TOKEN_CACHE.
+
+    Args:
+        token (str): String to anonymize.
+
+    Returns:
+        str: Anonymized token.
+    """
+    return TOKEN_CACHE.get(token)
+
+
+def _overlaps(prefix_side: str, suffix_side: str) -> bool:
+    """Returns True if a proper suffix of prefix_side is a prefix of suffix_side"""
+    if not suffix_side:
+        return False
+    start = prefix_side.find(suffix_side[0], 1)
+    while start != -1:
+        if suffix_side.startswith(prefix_side[start:]):
+            return True
+        start = prefix_side.find(suffix_side[0], start + 1)
+    return False
+
+
+def _has_conflicts(replacements: dict) -> bool:
+    """Has Conflicts
+    Checks whether replacing the targets one after the other could differ from replacing all
+    their original occurrences at once. That happens only when a target contains or overlaps
+    another target or a token, as a replacement could then break or create an occurrence.
+
+    Args:
+        replacements (dict): target -> token
+
+    Returns:
+        bool: True if the targets must be replaced one after the other
+    """
+    targets = list(replacements)
+    strings = targets + list(replacements.values())
+    for target in targets:
+        for other in strings:
+            if other is target:
+                continue
+            if target in other or other in target or _overlaps(target, other) or \
+                    _overlaps(other, target):
+                return True
+    return False
+
+
+def _replace_targets(content: str, targets: list) -> str:
+    """Replace Targets
+    Replaces every occurrence of every target with its anonymization token. The output is the
+    same as calling content.replace(target, token) for each target in order, but the content
+    is scanned once per target and built with a single splice.
+
+    Args:
+        content (str): String to anonymize.
+        targets (list): Strings to anonymize, in order.
+
+    Returns:
+        str: Anonymized String
+    """
+    replacements = {target: _anonymize_token(target) for target in targets}
+    if len(replacements) > 1 and _has_conflicts(replacements):
+        for target, token in replacements.items():
+            content = content.replace(target, token)
+        return content
+
+    spans = []
+    for target, token in replacements.items():
+        start = content.find(target)
+        while start != -1:
+            spans.append((start, start + len(target), token))
+            start = content.find(target, start + len(target))
+
+    if not spans:
+        return content
+
+    spans.sort()
+    parts = []
+    position = 0
+    for start, end, token in spans:
+        parts.append(content[position:start])
+        parts.append(token)
+        position = end
+    parts.append(content[position:])
+    return ''.join(parts)
+
+
+def compile_anonymize_emails(blacklisted_patterns: list) -> callable:
+    """Compile anonymize emails
+    Returns anonymize_emails bound to the blacklisted patterns, which are lowercased once
+
+    Args:
+        blacklisted_patterns (str): list of paterns to exclude from anaoymization
+
+    Returns:
+        callable: content, field -> anonymized content
+    """
+    patterns = tuple(x.lower() for x in blacklisted_patterns or [])
+
+    def anonymize(content: str, field: str = None) -> str:
+        targets = []
+        for email in EMAIL_REGEX.findall(content):
+
+            # if email address is blacklisted, continue to the next email address.
+            lowered = email.lower()
+            if any(x in lowered for x in patterns):
+                continue
+
+            targets.append(email.strip(string.punctuation))
+
+        return _replace_targets(content, targets)
+
+    return anonymize
+
+
+def _phone_windows(content: str) -> list:
+    """Phone windows
+    Splits the content into the spans the phone number matcher has to scan. Spans are cut in
+    the middle of long digitless gaps, which no phone number can cross, so a span keeps all
+    the context the matcher checks around its numbers. Spans with too few digits to hold a
+    valid number are dropped, adjacent ones are merged back.
+
+    Args:
+        content (str): String to scan
+
+    Returns:
+        list: (start, end) of the spans to scan
+    """
+    windows = []
+    start = 0
+    previous = None
+    count = 0
+    for match in DIGITS_REGEX.finditer(content):
+        position = match.start()
+        if previous is not None and position - previous > PHONE_WINDOW_GAP:
+            gap = content[previous:position]
+            if len(gap) - len(PHONE_SEPARATORS_REGEX.findall(gap)) > PHONE_WINDOW_GAP:
+                cut = previous + len(gap) // 2
+                if count >= MIN_PHONE_DIGITS:
+                    _add_window(windows, start, cut)
+                start = cut
+                count = 0
+        # End of the digits run
+        previous = match.end()
+        count += previous - position
+
+    if count >= MIN_PHONE_DIGITS:
+        _add_window(windows, start, len(content))
+    return windows
+
+
+def _add_window(windows: list, start: int, end: int):
+    """Adds the span to the windows, merged with the previous one if they are adjacent"""
+    if windows and windows[-1][1] == start:
+        windows[-1] = (windows[-1][0], end)
+    else:
+        windows.append((start, end))
+
+
+class PrefilterStats():
+    '''Prefilter Stats
+    Counts per field how many strings and characters the phone number pre-filter kept away
+    from the phone number matcher
+    '''
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._strings = Counter()
+        self._skipped = Counter()
+        self._chars = Counter()
+        self._scanned_chars = Counter()
+
+    def record(self, field: str, chars: int, scanned_chars: int):
+        """Records a string of the field and the number of its characters which were scanned"""
+        with self._lock:
+            self._strings[field] += 1
+            self._chars[field] += chars
+            self._scanned_chars[field] += scanned_chars
+            if not scanned_chars:
+                self._skipped[field] += 1
+
+    def drain(self) -> tuple:
+        """Drain
+        Returns the counters recorded since the last drain, and resets them
+        """
+        with self._lock:
+            counters = (self._strings, self._skipped, self._chars, self._scanned_chars)
+            self._strings, self._skipped = Counter(), Counter()
+            self._chars, self._scanned_chars = Counter(), Counter()
+            return counters
+
+    def merge(self, counters: tuple):
+        """Merge
+        Adds counters drained from other stats, like the ones of a worker process
+        """
+        strings, skipped, chars, scanned_chars = counters
+        with self._lock:
+            self._strings.update(strings)
+            self._skipped.update(skipped)
+            self._chars.update(chars)
+            self._scanned_chars.update(scanned_chars)
+
+    def stats(self) -> dict:
+        """Stats
+        Returns field -> strings, skipped strings, characters and scanned characters, with the
+        totals under None
+        """
+        with self._lock:
+            fields = {field: {'strings': self._strings[field], 'skipped': self._skipped[field],
+                              'chars': self._chars[field],
+                              'scanned_chars': self._scanned_chars[field]}
+                      for field in self._strings}
+        fields[None] = {name: sum(field[name] for field in fields.values())
+                        for name in ('strings', 'skipped', 'chars', 'scanned_chars')}
+        return fields
+
+
+PHONE_PREFILTER_STATS = PrefilterStats()
+
+
+def compile_anonymize_phone_numbers(blacklisted_patterns: list) -> callable:
+    """Compile anonymize phone numbers
+    Returns anonymize_phone_numbers bound to the blacklisted patterns, which are lowercased
+    once. The phone number matcher only scans the parts of the content which can hold a phone
+    number (see _phone_windows), the skipped parts are counted in PHONE_PREFILTER_STATS.
+
+    Args:
+        blacklisted_patterns (str): list of paterns to exclude from anaoymization
+
+    Returns:
+        callable: content, field -> anonymized content
+    """
+    patterns = tuple(x.lower() for x in blacklisted_patterns or [])
+
+    def anonymize(content: str, field: str = None) -> str:
+        windows = _phone_windows(content)
+        PHONE_PREFILTER_STATS.record(field, len(content),
+                                     sum(end - start for start, end in windows))
+
+        targets = []
+        for start, end in windows:
+            window = content[start:end] if end - start < len(content) else content
+            for match in phonenumbers.PhoneNumberMatcher(window, "US"):
+
+                # If number is blacklisted, continue to the next number
+                if any(x in match.raw_string for x in patterns):
+                    continue
+
+                targets.append(match.raw_string)
+
+        return _replace_targets(content, targets)
+
+    return anonymize
+
+
 def anonymize_emails(content: str, blacklisted_patterns: list) -> str:
     """Anonymize
     Anonymize all email addresses, except the ones matching any of the blacklisted patterns
@@ -39,19 +384,9 @@ def anonymize_emails(content: str, blacklisted_patterns: list) -> str:
         blacklisted_patterns (str): list of paterns to exclude from anaoymization
 
     Returns:
-        (list): List of all the tokens in the ticket
+        str: Anonymized String
     """
-    for email in EMAIL_REGEX.findall(content):
-
-        # if email address is blacklisted, continue to the next email address.
-        if any(x.lower() in email.lower() for x in blacklisted_patterns):
-            continue
-
-        email = email.strip(string.punctuation)
-        token = _anonymize_token(email)
-        content = content.replace(email, token)
-
-    return content
+    return compile_anonymize_emails(blacklisted_patterns)(content)
 
 
 def anonymize_phone_numbers(content: str, blacklisted_patterns: list) -> str:
@@ -63,15 +398,27 @@ def anonymize_phone_numbers(content: str, blacklisted_patterns: list) -> str:
     Returns:
         str: Anonymized String
     """
-    for match in phonenumbers.PhoneNumberMatcher(content, "US"):
+    return compile_anonymize_phone_numbers(blacklisted_patterns)(content)
 
-        # If number is blacklisted, continue to the next number
-        if any(x.lower() in match.raw_string for x in blacklisted_patterns):
-            continue
 
-        token = _anonymize_token(match.raw_string)
-        content = content.replace(match.raw_string, token)
-    return content
+def compile_action(function_name: str, blacklisted_patterns: list) -> callable:
+    """Compile action
+    Returns the action bound to its blacklisted patterns. Actions without a compiler in
+    COMPILERS are called with the patterns as is.
+
+    Args:
+        function_name (str): Name of the action in FUNCTIONS
+        blacklisted_patterns (str): list of paterns to exclude from anaoymization
+
+    Returns:
+        callable: content, field -> altered content
+    """
+    if function_name in COMPILERS:
+        return COMPILERS[function_name](blacklisted_patterns)
+
+    function = FUNCTIONS[function_name]
+    patterns = blacklisted_patterns or []
+    return lambda content, field=None: function(content, patterns)
 
 
 ###############################################################################################
@@ -83,3 +430,9 @@ FUNCTIONS = {
     'anonymize_emails': anonymize_emails,
     'anonymize_phone_numbers': anonymize_phone_numbers
 }
+
+# Functions which compile an action once for its blacklisted patterns
+COMPILERS = {
+    'anonymize_emails': compile_anonymize_emails,
+    'anonymize_phone_numbers': compile_anonymize_phone_numbers
+}
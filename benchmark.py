@@ -0,0 +1,625 @@
+"""Offline benchmark
+
+Pulls synthetic corpora from a local stand-in for the Zendesk and Jira APIs, applies the post
+actions and writes the items to an in-process sink (or to a local Postgres), and reports the
+throughput, batch latency and memory of each stage.
+
+The stand-in server runs in its own process, so its CPU time and memory are not counted. The
+sink serializes the rows like the DB driver would, and drops them.
+
+Usage:
+    python benchmark.py --sources articles tickets jira --sizes 1000 10000
+    python benchmark.py --target config.yaml --write-mode copy --output bench.json
+
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from psycopg2.extras import Json
+
+from retrievers import RETRIEVERS, transport
+from utils import read_yaml, prepare_post_actions_field_map, apply_post_actions_batch, \
+    dump_results_to_db, DBconnection, CopyLoader, WRITE_MODES, WRITE_MODE_ROW, WRITE_MODE_COPY
+from metrics import STAGE_FETCH, STAGE_POST_ACTIONS, STAGE_WRITE
+
+LOG = logging.getLogger("root")
+EXIT_CODE_ON_ERR = 1
+
+STAGES = (STAGE_FETCH, STAGE_POST_ACTIONS, STAGE_WRITE)
+SOURCES = ('articles', 'tickets', 'jira')
+
+DEF_SIZES = [1000]
+DEF_BODY_WORDS = 200
+DEF_COMMENTS = 3
+# Seconds to wait for the stand-in server to generate its corpus
+SERVER_START_TIMEOUT = 300
+# Seconds between two samples of the resident memory while a stage runs
+RSS_SAMPLE_INTERVAL = 0.005
+
+# Page sizes of the stood in APIs
+ARTICLES_PER_PAGE = 30
+ARTICLES_MAX_PER_PAGE = 100
+TICKETS_PER_PAGE = 1000
+JIRA_MAX_RESULTS = 100
+
+SUBDOMAIN = 'bench'
+# Requests to the Zendesk host are sent to the stand-in server instead
+ZENDESK_URL_REGEX = re.compile(r'^https://[^/]+\.zendesk\.com')
+ZENDESK_URL = f'https://{SUBDOMAIN}.zendesk.com'
+START_TIME = datetime(2020, 1, 1)
+
+# Sizes of the related objects pools
+USERS = 100
+GROUPS = 5
+ORGANIZATIONS = 20
+SECTIONS = 10
+CATEGORIES = 3
+TICKET_FIELDS = 5
+
+WORDS = ('account', 'order', 'invoice', 'refund', 'shipping', 'password', 'login', 'error',
+         'update', 'please', 'thanks', 'customer', 'issue', 'the', 'a', 'to', 'and', 'is', 'not',
+         'working', 'since', 'yesterday', 'we', 'need', 'help', 'with', 'our', 'new', 'plan',
+         'billing', 'export', 'report', 'dashboard', 'email', 'phone', 'call', 'back', 'asap',
+         'subscription', 'renewal', 'cancel', 'support', 'team', 'ticket', 'priority', 'high')
+EMAIL_DOMAINS = ('acme.com', 'example.com', 'mail.example.org', 'customer.io')
+PHONE_FORMATS = ('+1 415 555 {:04d}', '(212) 555-{:04d}', '054-123{:04d}', '+44 20 7946 {:04d}')
+# Roughly one email and one phone number per EMBED_EVERY words
+EMBED_EVERY = 50
+
+# Post actions of the benchmarked sources, as in config-template.yaml
+BENCH_POST_ACTIONS = [
+    {'function': 'anonymize_emails', 'apply_to_all': True,
+     'blacklisted_patterns': ['@acme.com'], 'blacklisted_fields': ['id']},
+    {'function': 'anonymize_phone_numbers', 'apply_to_all': True,
+     'blacklisted_patterns': ['@acme.com'], 'blacklisted_fields': ['id']},
+]
+
+
+def _iso_time(minutes: int) -> str:
+    """Returns the ISO 8601 time, the given minutes after START_TIME"""
+    return (START_TIME + timedelta(minutes=minutes)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Corpus():
+    '''Corpus
+    Synthetic items in the formats of the Zendesk and Jira APIs. Items are generated from the
+    seed, so every run of the same size pulls the same content.
+    '''
+
+    def __init__(self, size: int, body_words: int = DEF_BODY_WORDS,
+                 comments: int = DEF_COMMENTS, seed: int = 0) -> None:
+        self._rng = random.Random(seed)
+        self._body_words = body_words
+        self.size = size
+        self.users = [{'id': i + 1, 'name': f'User {i + 1}', 'email': self._email(),
+                       'role': 'end-user', 'phone': self._phone()} for i in range(USERS)]
+        self.groups = [{'id': i + 1, 'name': f'Group {i + 1}'} for i in range(GROUPS)]
+        self.organizations = [{'id': i + 1, 'name': f'Organization {i + 1}'}
+                              for i in range(ORGANIZATIONS)]
+        self.categories = [{'id': i + 1, 'name': f'Category {i + 1}'} for i in range(CATEGORIES)]
+        self.sections = [{'id': i + 1, 'name': f'Section {i + 1}',
+                          'category_id': i % CATEGORIES + 1} for i in range(SECTIONS)]
+        self.ticket_fields = [{'id': i + 1, 'type': 'text', 'title': f'Field {i + 1}',
+                               'description': '', 'required': False, 'active': True}
+                              for i in range(TICKET_FIELDS)]
+        self.articles = [self._article(i) for i in range(size)]
+        self.tickets = [self._ticket(i) for i in range(size)]
+        self.comments = {t['id']: [self._comment(t['id'] * 100 + j, t['requester_id'])
+                                   for j in range(comments)] for t in self.tickets}
+        self.issues = [self._issue(i, comments) for i in range(size)]
+
+    def _email(self) -> str:
+        return f"{self._rng.choice(WORDS)}{self._rng.randrange(1000)}@" \
+            f"{self._rng.choice(EMAIL_DOMAINS)}"
+
+    def _phone(self) -> str:
+        return self._rng.choice(PHONE_FORMATS).format(self._rng.randrange(10000))
+
+    def _text(self, words: int = None) -> str:
+        """Returns words of text, with emails and phone numbers in between"""
+        words = self._body_words if words is None else words
+        text = []
+        for i in range(words):
+            text.append(self._rng.choice(WORDS))
+            if i % EMBED_EVERY == EMBED_EVERY // 2:
+                text.append(self._email())
+                text.append(self._phone())
+        return ' '.join(text)
+
+    def _article(self, i: int) -> dict:
+        return {'id': i + 1, 'url': f'{ZENDESK_URL}/api/v2/help_center/articles/{i + 1}.json',
+                'html_url': f'https://{SUBDOMAIN}.zendesk.com/hc/articles/{i + 1}',
+                'author_id': self._rng.choice(self.users)['id'],
+                'section_id': self._rng.choice(self.sections)['id'],
+                'title': self._text(8), 'body': f'<p>{self._text()}</p>', 'locale': 'en-us',
+                'draft': False, 'label_names': [], 'vote_sum': 0,
+                'created_at': _iso_time(i), 'updated_at': _iso_time(i), 'edited_at': _iso_time(i)}
+
+    def _ticket(self, i: int) -> dict:
+        requester = self._rng.choice(self.users)
+        fields = [{'id': f['id'], 'value': self._text(3)} for f in self.ticket_fields]
+        return {'id': i + 1, 'url': f'{ZENDESK_URL}/api/v2/tickets/{i + 1}.json',
+                'subject': self._text(8), 'raw_subject': self._text(8),
+                'description': self._text(), 'status': self._rng.choice(('open', 'solved')),
+                'priority': 'normal', 'type': 'question', 'requester_id': requester['id'],
+                'submitter_id': requester['id'], 'assignee_id': self._rng.choice(self.users)['id'],
+                'group_id': self._rng.choice(self.groups)['id'],
+                'organization_id': self._rng.choice(self.organizations)['id'],
+                'collaborator_ids': [], 'tags': self._text(3).split(), 'custom_fields': fields,
+                'fields': fields, 'has_incidents': False,
+                'via': {'channel': 'email', 'source': {'from': {'address': requester['email']},
+                                                       'to': {}, 'rel': None}},
+                'created_at': _iso_time(i), 'updated_at': _iso_time(i),
+                'generated_timestamp': int((START_TIME + timedelta(minutes=i)).timestamp())}
+
+    def _comment(self, comment_id: int, author_id: int) -> dict:
+        body = self._text()
+        return {'id': comment_id, 'type': 'Comment', 'author_id': author_id, 'body': body,
+                'html_body': f'<p>{body}</p>', 'public': True, 'created_at': _iso_time(0)}
+
+    def _issue(self, i: int, comments: int) -> dict:
+        description = self._text()
+        reporter = self._rng.choice(self.users)
+        return {'id': str(10000 + i), 'key': f'BENCH-{i + 1}',
+                'fields': {'summary': self._text(8), 'created': _iso_time(i),
+                           'updated': _iso_time(i), 'description': description,
+                           'status': {'name': 'Open'},
+                           'reporter': {'displayName': reporter['name'],
+                                        'emailAddress': reporter['email']},
+                           'comment': {'total': comments, 'comments': [
+                               {'id': str(j), 'body': self._text(), 'created': _iso_time(i),
+                                'author': {'displayName': reporter['name']}}
+                               for j in range(comments)]},
+                           'customfield_10001': self._rng.randrange(13),
+                           'customfield_10002': self._text(3)},
+                'renderedFields': {'description': f'<p>{description}</p>'}}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''Serves the pages of the server's corpus, in the formats of the Zendesk and Jira APIs'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        for pattern, page in self.server.routes:
+            match = pattern.fullmatch(url.path)
+            if match:
+                self._send(200, page(query, url.path, *match.groups()))
+                return
+        self._send(404, {'error': 'Not found'})
+
+    def _send(self, status: int, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''Stand-in Server
+    Local stand-in for the Zendesk and Jira APIs, serving the corpus
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, corpus: Corpus) -> None:
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.corpus = corpus
+        self.routes = [(re.compile(pattern), page) for pattern, page in (
+            (r'/api/v2/help_center/categories\.json',
+             lambda q, path: {'categories': corpus.categories, 'next_page': None}),
+            (r'/api/v2/help_center/sections\.json',
+             lambda q, path: {'sections': corpus.sections, 'next_page': None}),
+            (r'/api/v2/help_center/incremental/articles\.json', self._articles_page),
+            (r'/api/v2/help_center/([^/]+)/articles\.json', self._articles_page),
+            (r'/api/v2/ticket_fields\.json',
+             lambda q, path: {'ticket_fields': corpus.ticket_fields, 'next_page': None,
+                              'count': len(corpus.ticket_fields)}),
+            (r'/api/v2/tickets/(\d+)/comments\.json', self._comments_page),
+            (r'/api/v2/incremental/tickets/cursor\.json', self._tickets_export_page),
+            (r'/api/v2/incremental/tickets\.json', self._tickets_page),
+            (r'/rest/api/2/field', lambda q, path: [
+                {'id': 'customfield_10001', 'name': 'Story Points', 'custom': True},
+                {'id': 'customfield_10002', 'name': 'Team', 'custom': True},
+                {'id': 'summary', 'name': 'Summary', 'custom': False}]),
+            (r'/rest/api/2/myself', lambda q, path: {'timeZone': 'UTC'}),
+            (r'/rest/api/2/search', self._issues_page),
+        )]
+
+    def _articles_page(self, query: dict, path: str, locale: str = None) -> dict:
+        per_page = min(int(query.get('per_page', ARTICLES_PER_PAGE)), ARTICLES_MAX_PER_PAGE)
+        page = int(query.get('page', 1))
+        articles = self.corpus.articles[(page - 1) * per_page:page * per_page]
+        next_page = None
+        if page * per_page < self.corpus.size:
+            next_page = f"{ZENDESK_URL}{path}?start_time={query.get('start_time', 0)}" \
+                f"&page={page + 1}&per_page={per_page}"
+        return {'articles': articles, 'next_page': next_page, 'page': page,
+                'per_page': per_page, 'count': self.corpus.size}
+
+    def _comments_page(self, query: dict, path: str, ticket_id: str) -> dict:
+        comments = self.corpus.comments.get(int(ticket_id), [])
+        return {'comments': comments, 'next_page': None, 'count': len(comments)}
+
+    def _tickets_slice(self, start: int) -> dict:
+        """Returns a page of tickets, along with their side-loaded related objects"""
+        tickets = self.corpus.tickets[start:start + TICKETS_PER_PAGE]
+        users = {t[k] for t in tickets for k in ('requester_id', 'submitter_id', 'assignee_id')}
+        return {'tickets': tickets, 'count': len(tickets),
+                'users': [self.corpus.users[i - 1] for i in sorted(users)],
+                'groups': self.corpus.groups, 'organizations': self.corpus.organizations}
+
+    def _tickets_export_page(self, query: dict, path: str) -> dict:
+        start = int(query.get('cursor', 0))
+        end = start + TICKETS_PER_PAGE
+        data = self._tickets_slice(start)
+        data.update({'after_cursor': str(end), 'before_cursor': str(start),
+                     'end_of_stream': end >= self.corpus.size,
+                     'after_url': f'{ZENDESK_URL}/api/v2/incremental/tickets/cursor.json'
+                                  f'?cursor={end}'})
+        return data
+
+    def _tickets_page(self, query: dict, path: str) -> dict:
+        start = int(query.get('offset', 0))
+        end = start + TICKETS_PER_PAGE
+        data = self._tickets_slice(start)
+        data.update({'end_of_stream': end >= self.corpus.size,
+                     'end_time': int(START_TIME.timestamp()) + end,
+                     'next_page': f"{ZENDESK_URL}/api/v2/incremental/tickets.json"
+                                  f"?start_time={query.get('start_time', 0)}&offset={end}"})
+        return data
+
+    def _issues_page(self, query: dict, path: str) -> dict:
+        start = int(query.get('startAt', 0))
+        limit = min(int(query.get('maxResults', 50)), JIRA_MAX_RESULTS)
+        return {'startAt': start, 'maxResults': limit, 'total': self.corpus.size,
+                'issues': self.corpus.issues[start:start + limit]}
+
+
+def serve(corpus_args: dict, conn):
+    """Runs the stand-in server in a child process, and sends its port once it is ready"""
+    server = StandInServer(Corpus(**corpus_args))
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+
+class StandIn():
+    '''Stand-in
+    Runs a stand-in server in a child process, and sends the retrievers' requests to it while
+    the context is entered
+    '''
+
+    def __init__(self, **corpus_args) -> None:
+        self._corpus_args = corpus_args
+        self._process = None
+        self._adapter_class = None
+        self.url = None
+
+    def __enter__(self):
+        context = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = context.Pipe()
+        self._process = context.Process(target=serve, args=(self._corpus_args, child_conn),
+                                        daemon=True)
+        self._process.start()
+        if not parent_conn.poll(SERVER_START_TIMEOUT):
+            self._process.terminate()
+            raise RuntimeError('The stand-in server did not start')
+        self.url = f'http://127.0.0.1:{parent_conn.recv()}'
+
+        # Sessions are created by the retrievers, so the adapter they mount is replaced
+        base_url = self.url
+        self._adapter_class = transport.ThrottledAdapter
+
+        class StandInAdapter(self._adapter_class):
+            '''Sends the requests to the Zendesk host to the stand-in server'''
+
+            def send(self, request, **kwargs):
+                url = request.url
+                request.url = ZENDESK_URL_REGEX.sub(base_url, url, count=1)
+                response = super().send(request, **kwargs)
+                # Zenpy matches the responses with its API by their request URL
+                request.url = response.url = url
+                return response
+
+        transport.ThrottledAdapter = StandInAdapter
+        return self
+
+    def __exit__(self, *exc):
+        transport.ThrottledAdapter = self._adapter_class
+        self._process.terminate()
+        self._process.join()
+
+
+class SinkCursor():
+    '''Sink Cursor
+    In-process stand-in for a DB cursor. Statements parameters and COPY streams are serialized
+    like the DB driver would, and dropped.
+    '''
+
+    def __init__(self) -> None:
+        self.connection = SimpleNamespace(encoding='UTF8')
+        self.statements = 0
+        self.bytes = 0
+
+    def execute(self, sql, args=None):
+        self.statements += 1
+        if args is not None:
+            self.bytes += len(self.mogrify(sql, args))
+        elif isinstance(sql, bytes):
+            self.bytes += len(sql)
+
+    def mogrify(self, sql, args) -> bytes:
+        values = [a.dumps(a.adapted) if isinstance(a, Json) else a for a in args]
+        return json.dumps(values, default=str).encode('utf-8')
+
+    def copy_expert(self, sql, file, size: int = 8192):
+        self.statements += 1
+        data = file.read(size)
+        while data:
+            self.bytes += len(data)
+            data = file.read(size)
+
+    def fetchall(self) -> list:
+        return []
+
+
+def get_rss() -> int:
+    """Returns the resident memory of the process in bytes"""
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Only the peak is known
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values: list, q: float) -> float:
+    """Returns the q (0 to 1) nearest rank percentile of the values, 0 if there are none"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class StageStats():
+    '''Items, time, batch latencies and peak memory of a stage'''
+
+    def __init__(self) -> None:
+        self.items = 0
+        self.seconds = 0.0
+        self.latencies: list = []
+        self.peak_rss = 0
+
+    def record(self, items: int, seconds: float, batch: bool = True):
+        """Records a stage run over a batch of items (or its work outside of batches)"""
+        self.items += items
+        self.seconds += seconds
+        if batch:
+            self.latencies.append(seconds)
+        self.record_rss()
+
+    def record_rss(self):
+        """Records the current resident memory, if it is the stage's peak"""
+        self.peak_rss = max(self.peak_rss, get_rss())
+
+    def report(self) -> dict:
+        return {'items': self.items, 'batches': len(self.latencies),
+                'seconds': round(self.seconds, 3),
+                'items_per_sec': round(self.items / self.seconds, 1) if self.seconds else None,
+                'p50_ms': round(percentile(self.latencies, 0.5) * 1000, 2),
+                'p99_ms': round(percentile(self.latencies, 0.99) * 1000, 2),
+                'peak_rss_mb': round(self.peak_rss / 2 ** 20, 1)}
+
+
+class RssSampler():
+    '''Samples the resident memory from a background thread while the stages run, so the
+    peak of every stage is recorded and not only its memory when it ends'''
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL) -> None:
+        self.stage: StageStats = None
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            stage = self.stage
+            if stage:
+                stage.record_rss()
+
+
+def get_source_config(source: str, url: str) -> tuple:
+    """Returns the retriever type and params of a benchmarked source"""
+    if source == 'articles':
+        return 'ZendeskArticles', {'subdomain': SUBDOMAIN, 'locale': 'en-us',
+                                   'credentials': {'username': 'bench', 'password': 'bench'}}
+    if source == 'tickets':
+        return 'ZendeskTickets', {'credentials': {'email': 'bench@example.com',
+                                                  'token': 'bench', 'subdomain': SUBDOMAIN},
+                                  'export_mode': True, 'comments_concurrency': 4}
+    return 'Jira', {'credentials': {'url': url, 'username': 'bench', 'password': 'bench'},
+                    'projects': ['BENCH'], 'page_size': JIRA_MAX_RESULTS}
+
+
+def benchmark_source(source: str, url: str, params: dict, cursor, write_mode: str) -> dict:
+    """Benchmark source
+    Pulls the source from the stand-in server, one stage at a time, and returns its report
+
+    Args:
+        source (str): One of SOURCES
+        url (str): Stand-in server URL
+        params (dict): Retriever params overriding the benchmark ones
+        cursor: DB cursor, or SinkCursor
+        write_mode (str): One of WRITE_MODES
+
+    Returns:
+        dict: the items, wall time and overall throughput, and the stats of every stage
+    """
+    retriever_type, retriever_params = get_source_config(source, url)
+    retriever_params.update(params)
+    source_name = f'Bench{retriever_type}'
+    post_action_map = prepare_post_actions_field_map(BENCH_POST_ACTIONS)
+    loader = None
+    if write_mode == WRITE_MODE_COPY:
+        loader = CopyLoader(cursor, source_name)
+
+    stats = {stage: StageStats() for stage in STAGES}
+    failures = 0
+    sampler = RssSampler()
+    sampler.start()
+    started = time.perf_counter()
+    retriever = RETRIEVERS[retriever_type.lower()](source=source_name, start_time=START_TIME,
+                                                   ignore_deleted=True, max_items=None,
+                                                   **retriever_params)
+    batches = iter(retriever)
+    while True:
+        sampler.stage = stats[STAGE_FETCH]
+        stage_started = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            # Work done after the last batch, like syncing deleted items
+            stats[STAGE_FETCH].record(0, time.perf_counter() - stage_started, batch=False)
+            break
+        stats[STAGE_FETCH].record(len(batch), time.perf_counter() - stage_started)
+
+        sampler.stage = stats[STAGE_POST_ACTIONS]
+        stage_started = time.perf_counter()
+        batch = apply_post_actions_batch(batch, post_action_map)
+        stats[STAGE_POST_ACTIONS].record(len(batch), time.perf_counter() - stage_started)
+
+        sampler.stage = stats[STAGE_WRITE]
+        stage_started = time.perf_counter()
+        _, batch_failures = dump_results_to_db(batch, source_name, cursor, write_mode, loader)
+        failures += batch_failures
+        stats[STAGE_WRITE].record(len(batch), time.perf_counter() - stage_started)
+
+    if loader:
+        sampler.stage = stats[STAGE_WRITE]
+        stage_started = time.perf_counter()
+        _, flush_failures = loader.flush()
+        failures += flush_failures
+        stats[STAGE_WRITE].record(0, time.perf_counter() - stage_started, batch=False)
+
+    seconds = time.perf_counter() - started
+    sampler.stop()
+    items = stats[STAGE_FETCH].items
+    return {'source': source, 'write_mode': write_mode, 'items': items, 'failures': failures,
+            'seconds': round(seconds, 3),
+            'items_per_sec': round(items / seconds, 1) if seconds else None,
+            'stages': {stage: stage_stats.report() for stage, stage_stats in stats.items()}}
+
+
+def print_report(report: dict):
+    """Prints a source benchmark report"""
+    print(f"{report['source']}, {report['size']} items, {report['write_mode']} writes: "
+          f"{report['items_per_sec']} items/s in {report['seconds']} seconds "
+          f"({report['failures']} items failed)")
+    print(f"  {'stage':<14}{'items/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'peak RSS MB':>13}")
+    for stage, stats in report['stages'].items():
+        print(f"  {stage:<14}{stats['items_per_sec'] or 0:>10}{stats['p50_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['peak_rss_mb']:>13}")
+
+
+def create_argparser() -> argparse.ArgumentParser:
+    """Parses and returns command line arguments"""
+    HELP_SOURCES = 'Sources to benchmark (default: all)'
+    HELP_SIZES = f'Corpus sizes, in items per source (default: {DEF_SIZES})'
+    HELP_WRITEMODE = 'How to write items to DB (default: row)'
+    HELP_TARGET = 'Configuration with a Target block, to write to a local Postgres instead of '\
+        'the in-process sink'
+    HELP_PARAMS = 'YAML file of retriever params by source, like "tickets: {export_mode: false}"'
+    HELP_BODYWORDS = f'Words in each item body and comment (default: {DEF_BODY_WORDS})'
+    HELP_COMMENTS = f'Comments per ticket and issue (default: {DEF_COMMENTS})'
+    HELP_SEED = 'Seed of the corpus content (default: 0)'
+    HELP_OUTPUT = 'Path of a JSON report to write'
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--sources', nargs='+', choices=SOURCES, default=list(SOURCES),
+                        help=HELP_SOURCES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEF_SIZES, help=HELP_SIZES)
+    parser.add_argument('--write-mode', choices=WRITE_MODES, default=WRITE_MODE_ROW,
+                        help=HELP_WRITEMODE)
+    parser.add_argument('--target', type=str, help=HELP_TARGET)
+    parser.add_argument('--params', type=str, help=HELP_PARAMS)
+    parser.add_argument('--body-words', type=int, default=DEF_BODY_WORDS, help=HELP_BODYWORDS)
+    parser.add_argument('--comments', type=int, default=DEF_COMMENTS, help=HELP_COMMENTS)
+    parser.add_argument('--seed', type=int, default=0, help=HELP_SEED)
+    parser.add_argument('--output', type=str, help=HELP_OUTPUT)
+
+    return parser
+
+
+if __name__ == '__main__':
+    # Parses runtime arguments and runs the benchmarks
+
+    options = create_argparser().parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    params = read_yaml(options.params) if options.params else {}
+    if params is None:
+        sys.exit(EXIT_CODE_ON_ERR)
+
+    if options.target:
+        config = read_yaml(options.target)
+        if not config:
+            LOG.error(f'Could not open configuration file {options.target}')
+            sys.exit(EXIT_CODE_ON_ERR)
+        target = dict(config['Target'])
+        target.pop('write_mode', None)
+        cursor = DBconnection(target).get_cursor()
+    else:
+        # Deleted items syncs get their cursor from DBconnection
+        cursor = DBconnection(cursor=SinkCursor()).get_cursor()
+
+    # Sources keep their state (like export cursors) in the working directory, so every run
+    # starts from an empty one
+    work_dir = os.getcwd()
+    reports = []
+    for size in options.sizes:
+        with StandIn(size=size, body_words=options.body_words, comments=options.comments,
+                     seed=options.seed) as stand_in:
+            for source in options.sources:
+                with tempfile.TemporaryDirectory() as run_dir:
+                    os.chdir(run_dir)
+                    try:
+                        report = benchmark_source(source, stand_in.url,
+                                                  params.get(source) or {}, cursor,
+                                                  options.write_mode)
+                    finally:
+                        os.chdir(work_dir)
+                report['size'] = size
+                print_report(report)
+                reports.append(report)
+
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as file:
+            json.dump(reports, file, indent=2)
@@ -0,0 +1,134 @@
+import json
+import sqlite3
+import logging
+import threading
+from hashlib import sha256
+from collections import Counter
+
+LOG = logging.getLogger("root")
+CHANGE_INDEX_FILE_NAME = 'content_hashes.db'
+# SQLite limits the number of parameters of a single statement
+MAX_LOOKUP_IDS = 500
+
+INDEX_TABLE_SQL = "CREATE TABLE IF NOT EXISTS content_hash (target TEXT NOT NULL, "\
+                  "source TEXT NOT NULL, item_id TEXT NOT NULL, hash TEXT NOT NULL, "\
+                  "PRIMARY KEY (target, source, item_id)) WITHOUT ROWID"
+SELECT_HASHES_SQL = "SELECT item_id, hash FROM content_hash "\
+                    "WHERE target = ? AND source = ? AND item_id IN ({ids})"
+UPSERT_HASH_SQL = "INSERT OR REPLACE INTO content_hash (target, source, item_id, hash) "\
+                  "VALUES (?, ?, ?, ?)"
+
+
+def content_hash(item: dict) -> str:
+    """Content hash
+    Returns a stable hash of the item content, which doesn't depend on the keys order
+
+    Args:
+        item (dict): Post processed item
+
+    Returns:
+        str: SHA-256 hex digest of the item
+    """
+    content = json.dumps(item, sort_keys=True, default=str, separators=(',', ':'))
+    return sha256(content.encode('utf-8')).hexdigest()
+
+
+class ChangeIndex():
+    '''Change Index
+    Local index of the content hashes of the items written to the target DB. Items whose hash
+    didn't change since they were last written are skipped, instead of rewriting their row.
+
+    Hashes are keyed by the target DB, the source and the item id, and are only stored after
+    the items were written successfully.
+    '''
+
+    def __init__(self, target: str, path: str = CHANGE_INDEX_FILE_NAME) -> None:
+        """
+        Args:
+            target (str): Identifies the target DB (like host/dbname)
+            path (str, optional): SQLite file path. Defaults to CHANGE_INDEX_FILE_NAME.
+        """
+        self._target = target
+        self._lock = threading.Lock()
+        self._unchanged = Counter()
+        # Sources run in their own threads, they share the connection under the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(INDEX_TABLE_SQL)
+
+    def filter(self, source: str, results: list) -> tuple:
+        """Filter
+        Drops the items which didn't change since they were last written
+
+        Args:
+            source (str): Source name
+            results (list): Post processed items
+
+        Returns:
+            tuple: the changed items, and their (item id, hash) to commit once they are
+                written (None for items without an id)
+        """
+        hashes = []
+        for item in results:
+            item_id = item.get('id') if isinstance(item, dict) else None
+            hashes.append((str(item_id), content_hash(item)) if item_id is not None else None)
+
+        stored = self._get_hashes(source, [x[0] for x in hashes if x])
+        changed = []
+        changed_hashes = []
+        for item, item_hash in zip(results, hashes):
+            if item_hash and stored.get(item_hash[0]) == item_hash[1]:
+                continue
+            changed.append(item)
+            changed_hashes.append(item_hash)
+
+        with self._lock:
+            self._unchanged[source] += len(results) - len(changed)
+        return changed, changed_hashes
+
+    def commit(self, source: str, hashes: list):
+        """Commit
+        Stores the hashes of written items
+
+        Args:
+            source (str): Source name
+            hashes (list): (item id, hash) of the written items, as returned by filter
+        """
+        rows = [(self._target, source, item_id, item_hash)
+                for item_id, item_hash in filter(None, hashes)]
+        if not rows:
+            return
+
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.executemany(UPSERT_HASH_SQL, rows)
+            except Exception as e:
+                LOG.error('Got error while updating the change index')
+                LOG.debug(e)
+
+    def unchanged(self, source: str) -> int:
+        """Returns the number of items of the source which were skipped as unchanged"""
+        with self._lock:
+            return self._unchanged[source]
+
+    def close(self):
+        """Closes the index"""
+        with self._lock:
+            self._conn.close()
+
+    def _get_hashes(self, source: str, item_ids: list) -> dict:
+        """Returns item id -> stored hash of the given items"""
+        stored = {}
+        with self._lock:
+            try:
+                for i in range(0, len(item_ids), MAX_LOOKUP_IDS):
+                    ids = item_ids[i:i + MAX_LOOKUP_IDS]
+                    sql = SELECT_HASHES_SQL.format(ids=', '.join('?' * len(ids)))
+                    stored.update(self._conn.execute(sql, [self._target, source, *ids]))
+            except Exception as e:
+                # Without the stored hashes every item is written
+                LOG.error('Got error while reading the change index')
+                LOG.debug(e)
+                return {}
+        return stored
@@ -0,0 +1,129 @@
+import time
+import logging
+from collections.abc import Iterable
+from utils import load_state, save_state, LAST_PULL_KEY
+
+LOG = logging.getLogger("root")
+# Minimum seconds between checkpoint saves of a source. The last one is saved when it ends.
+CHECKPOINT_INTERVAL = 5
+# State key of the position an interrupted pull resumes from
+RESUME_KEY = 'resume'
+
+
+class CheckpointBatch(list):
+    '''Checkpoint Batch
+    Batch of retrieved items, along with the source state to save once all of them were
+    written (like the cursor of the next page).
+    '''
+
+    def __init__(self, items: Iterable = (), checkpoint: dict = None) -> None:
+        super().__init__(items)
+        self.checkpoint = checkpoint
+
+
+def get_checkpoint(batch: Iterable) -> dict:
+    """Returns the checkpoint of the batch, None if it has none"""
+    return getattr(batch, 'checkpoint', None)
+
+
+def with_checkpoint(batch: Iterable, checkpoint: dict) -> Iterable:
+    """Returns the batch with the checkpoint, which transforms of the batch don't keep"""
+    if checkpoint is None:
+        return batch
+    return CheckpointBatch(batch, checkpoint)
+
+
+def resume_checkpoint(run: object, position: dict) -> dict:
+    """Resume checkpoint
+    Returns the checkpoint of a position within a pull, which an interrupted pull of the same
+    run resumes from
+
+    Args:
+        run (object): Identifies the pull, like its start time. Positions of other pulls
+            are ignored (like when an earlier start time is given for a backfill).
+        position (dict): The position of the next items to pull
+
+    Returns:
+        dict: The checkpoint
+    """
+    return {RESUME_KEY: {'run': run, **position}}
+
+
+def load_resume_position(source: str, run: object) -> dict:
+    """Load resume position
+    Returns the position an interrupted pull of the source reached
+
+    Args:
+        source (str): Source name
+        run (object): Identifies the pull, as given to resume_checkpoint
+
+    Returns:
+        dict: The position, empty if the last pull of the source was complete or if it was
+            another run
+    """
+    position = load_state(source).get(RESUME_KEY) or {}
+    if position.get('run') != run:
+        return {}
+    LOG.info(f'Resuming {source} from the last checkpoint')
+    return position
+
+
+class SourceCheckpoints():
+    '''Source Checkpoints
+    Saves the checkpoints of a source's batches, in order, once their items were written. After
+    items failed, the following checkpoints are dropped, so an interrupted pull resumes before
+    the failed items.
+
+    Saves are spaced by CHECKPOINT_INTERVAL seconds, so a restarted pull may write again up to
+    that many seconds of batches.
+    '''
+
+    def __init__(self, source: str, interval: float = CHECKPOINT_INTERVAL) -> None:
+        self._source = source
+        self._interval = interval
+        self._added: dict = {}
+        self._committed: dict = {}
+        self._failed = False
+        self._saved_time = time.monotonic()
+
+    def add(self, checkpoint: dict):
+        """Adds the checkpoint of a batch, which is saved once it is committed"""
+        if checkpoint and not self._failed:
+            self._added.update(checkpoint)
+
+    def commit(self, failures: int = 0):
+        """Commit
+        Marks the items of the added checkpoints as written
+
+        Args:
+            failures (int, optional): Number of items which failed. Defaults to 0.
+        """
+        if failures:
+            if not self._failed:
+                LOG.warning(f'{self._source}: items failed, no later checkpoint is saved')
+            self._failed = True
+        else:
+            self._committed.update(self._added)
+        self._added = {}
+        if time.monotonic() - self._saved_time >= self._interval:
+            self.flush()
+
+    def flush(self):
+        """Saves the committed checkpoints"""
+        if self._committed:
+            save_state(self._source, self._committed)
+            self._committed = {}
+        self._saved_time = time.monotonic()
+
+    def complete(self, pull_time: str):
+        """Complete
+        Saves the committed checkpoints once the source was pulled to the end. The next pull
+        starts from the pull_time, and not from the resume position. After items failed, only
+        the checkpoints before them are saved, so the next pull retries the failed items.
+
+        Args:
+            pull_time (str): When the pull started
+        """
+        if not self._failed:
+            self._committed.update({LAST_PULL_KEY: pull_time, RESUME_KEY: None})
+        self.flush()
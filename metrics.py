@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import defaultdict
+
+LOG = logging.getLogger("root")
+# Prefix of the exported Prometheus metric names
+METRICS_PREFIX = 'retriever_'
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Pull stages, timed by the stage_seconds histogram
+STAGE_FETCH = 'fetch'
+STAGE_POST_ACTIONS = 'post_actions'
+STAGE_WRITE = 'write'
+
+COUNTERS = {
+    'items_retrieved_total': 'Items retrieved from the source',
+    'rows_upserted_total': 'Items written to the target DB',
+    'rows_failed_total': 'Items which failed to be post processed or written',
+    'rows_unchanged_total': 'Items skipped as unchanged since they were last written',
+    'http_requests_total': 'HTTP requests sent, including retries',
+    'http_response_bytes_total': 'Bytes of the HTTP response bodies, as received',
+    'http_retries_total': 'HTTP requests retried after errors or 429 responses',
+    'throttle_sleeps_total': 'Requests held back by the host throttle',
+    'throttle_sleep_seconds_total': 'Seconds requests were held back by the host throttle',
+}
+HISTOGRAMS = {
+    'http_request_seconds': 'Duration of HTTP requests, including retries',
+    'stage_seconds': 'Duration of the pull stages, per batch',
+}
+
+
+class Histogram():
+    '''Histogram
+    Counts of observations per latency bucket, along with their count and sum
+    '''
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # The last count is of the observations above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> list:
+        """Returns (upper bound, observations up to it) of every bucket, ending with +Inf"""
+        counts = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+class Metrics():
+    '''Metrics
+    Thread safe registry of the run counters and latency histograms. Metrics are labeled with
+    the source, and optionally with more labels (like the stage).
+
+    The run metrics are exported as a JSON report, or as a Prometheus textfile for the node
+    exporter textfile collector.
+    '''
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Inc
+        Increases a counter
+
+        Args:
+            name (str): One of COUNTERS
+            value (float, optional): Increment. Defaults to 1.
+            labels: Metric labels, like source
+        """
+        if not value:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name: str, value: float, **labels):
+        """Observe
+        Adds an observation to a histogram
+
+        Args:
+            name (str): One of HISTOGRAMS
+            value (float): Observed seconds
+            labels: Metric labels, like source
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observes the seconds spent in the context on the histogram"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def get(self, name: str, **labels) -> float:
+        """Returns the value of a counter"""
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_seconds(self, name: str, **labels) -> float:
+        """Returns the sum of a histogram's observations"""
+        with self._lock:
+            histogram = self._histograms.get((name, tuple(sorted(labels.items()))))
+            return histogram.sum if histogram else 0.0
+
+    def report(self) -> dict:
+        """Report
+        Returns the run metrics, by source. Metrics with more labels than the source are keyed
+        by their name and label values, like stage_seconds:fetch.
+
+        Returns:
+            dict: The run start time and duration, and the counters and histograms of every
+                source
+        """
+        sources = defaultdict(lambda: {'counters': {}, 'histograms': {}})
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                source, key = _get_report_key(name, labels)
+                sources[source]['counters'][key] = value
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                source, key = _get_report_key(name, labels)
+                sources[source]['histograms'][key] = {
+                    'count': histogram.count, 'sum': round(histogram.sum, 6),
+                    'buckets': {str(bound): count
+                                for bound, count in histogram.cumulative_counts()}}
+        return {'started': self._started, 'seconds': round(time.time() - self._started, 3),
+                'sources': dict(sources)}
+
+    def to_prometheus(self) -> str:
+        """Returns the run metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            for name, help_text in COUNTERS.items():
+                samples = [(labels, value) for (key, labels), value in
+                           sorted(self._counters.items()) if key == name]
+                if not samples:
+                    continue
+                lines.append(f'# HELP {METRICS_PREFIX}{name} {help_text}')
+                lines.append(f'# TYPE {METRICS_PREFIX}{name} counter')
+                for labels, value in samples:
+                    lines.append(f'{METRICS_PREFIX}{name}{_format_labels(labels)} '
+                                 f'{_format_value(value)}')
+
+            for name, help_text in HISTOGRAMS.items():
+                samples = [(labels, histogram) for (key, labels), histogram in
+                           sorted(self._histograms.items()) if key == name]
+                if not samples:
+                    continue
+                lines.append(f'# HELP {METRICS_PREFIX}{name} {help_text}')
+                lines.append(f'# TYPE {METRICS_PREFIX}{name} histogram')
+                for labels, histogram in samples:
+                    for bound, count in histogram.cumulative_counts():
+                        bucket_labels = labels + (('le', '+Inf' if bound == float('inf')
+                                                   else f'{bound:g}'),)
+                        lines.append(f'{METRICS_PREFIX}{name}_bucket'
+                                     f'{_format_labels(bucket_labels)} {count}')
+                    lines.append(f'{METRICS_PREFIX}{name}_sum{_format_labels(labels)} '
+                                 f'{_format_value(histogram.sum)}')
+                    lines.append(f'{METRICS_PREFIX}{name}_count{_format_labels(labels)} '
+                                 f'{histogram.count}')
+
+        lines.append(f'# HELP {METRICS_PREFIX}last_run_timestamp_seconds Start of the last run')
+        lines.append(f'# TYPE {METRICS_PREFIX}last_run_timestamp_seconds gauge')
+        lines.append(f'{METRICS_PREFIX}last_run_timestamp_seconds {self._started:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path: str) -> bool:
+        """Writes the JSON report of the run metrics, returns True if it was written"""
+        return _write_file(path, json.dumps(self.report(), indent=2))
+
+    def write_textfile(self, path: str) -> bool:
+        """Writes the run metrics as a Prometheus textfile, returns True if it was written"""
+        return _write_file(path, self.to_prometheus())
+
+
+def _get_report_key(name: str, labels: tuple) -> tuple:
+    """Returns the source of the metric, and its key in the source's report"""
+    labels = dict(labels)
+    source = labels.pop('source', None) or ''
+    key = ':'.join([name] + [str(v) for _, v in sorted(labels.items())])
+    return source, key
+
+
+def _format_labels(labels: tuple) -> str:
+    """Formats the labels of a Prometheus sample"""
+    if not labels:
+        return ''
+    values = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                      for k, v in labels)
+    return '{' + values + '}'
+
+
+def _format_value(value: float) -> str:
+    """Formats the value of a Prometheus sample, whole numbers without exponent"""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _write_file(path: str, content: str) -> bool:
+    """Replaces the file atomically, so collectors never read a partially written file"""
+    try:
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        LOG.error(f'Got error while writing metrics to {path}')
+        LOG.debug(e)
+        return False
+
+
+METRICS = Metrics()
@@ -0,0 +1,135 @@
+import queue
+import logging
+import threading
+from collections.abc import Iterable
+
+LOG = logging.getLogger("root")
+# Number of batches each stage may hold ahead of the next one
+DEF_QUEUE_SIZE = 4
+# Seconds between checks of the stop flag while waiting on a queue
+QUEUE_POLL_TIMEOUT = 0.5
+
+# Marks the end of the batches stream
+_DONE = object()
+
+
+class _Failure():
+    '''Carries an exception raised by a stage to the consumer'''
+
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+
+class Pipeline():
+    '''Pipeline
+    Runs the retrieve stage (iterating the retriever) and the transform stage (post actions)
+    of a source in their own threads. Iterating the pipeline (the load stage) yields the
+    transformed batches in order.
+
+    The stages are connected with bounded queues, so a slow consumer holds the retriever back
+    instead of letting fetched batches pile up in memory.
+    '''
+
+    def __init__(self, batches: Iterable, transform: callable,
+                 queue_size: int = DEF_QUEUE_SIZE, on_thread_exit: callable = None,
+                 on_thread_start: callable = None) -> None:
+        """
+        Args:
+            batches (Iterable): The retriever
+            transform (callable): Applied on every batch, returns the transformed batch
+            queue_size (int, optional): Bound of each queue. Defaults to DEF_QUEUE_SIZE.
+            on_thread_exit (callable, optional): Called by each stage thread when it ends,
+                to release per thread resources like DB connections.
+            on_thread_start (callable, optional): Called by each stage thread when it starts,
+                like to attach it to the source profile.
+        """
+        self._batches = batches
+        self._transform = transform
+        self._on_thread_exit = on_thread_exit
+        self._on_thread_start = on_thread_start
+        self._fetched = queue.Queue(maxsize=queue_size)
+        self._transformed = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+
+    def __iter__(self):
+        threads = [
+            threading.Thread(target=self._run_stage, args=(self._retrieve,), daemon=True,
+                             name=f'{threading.current_thread().name}-retrieve'),
+            threading.Thread(target=self._run_stage, args=(self._transform_batches,),
+                             daemon=True, name=f'{threading.current_thread().name}-transform')
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(self._transformed)
+                if item is None or item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            # Also stops the stages when the consumer fails or stops early
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _run_stage(self, stage: callable):
+        """Runs a stage and releases the thread resources when it ends"""
+        try:
+            if self._on_thread_start:
+                self._on_thread_start()
+            stage()
+        finally:
+            if self._on_thread_exit:
+                try:
+                    self._on_thread_exit()
+                except Exception as e:
+                    LOG.debug(e)
+
+    def _retrieve(self):
+        """Retrieve stage, puts the retrieved batches on the fetched queue"""
+        try:
+            for batch in self._batches:
+                if not self._put(self._fetched, batch):
+                    return
+            self._put(self._fetched, _DONE)
+        except Exception as e:
+            self._put(self._fetched, _Failure(e))
+
+    def _transform_batches(self):
+        """Transform stage, moves the fetched batches to the transformed queue"""
+        while True:
+            item = self._get(self._fetched)
+            if item is None:
+                return
+
+            if item is not _DONE and not isinstance(item, _Failure):
+                try:
+                    item = self._transform(item)
+                except Exception as e:
+                    item = _Failure(e)
+
+            if not self._put(self._transformed, item) or item is _DONE or \
+                    isinstance(item, _Failure):
+                return
+
+    def _put(self, target: queue.Queue, item) -> bool:
+        """Puts the item on the queue, returns False if the pipeline was stopped meanwhile"""
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=QUEUE_POLL_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue):
+        """Gets an item from the queue, returns None if the pipeline was stopped meanwhile"""
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=QUEUE_POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+        return None
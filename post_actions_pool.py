@@ -0,0 +1,142 @@
+import logging
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from actions import TOKEN_CACHE, PHONE_PREFILTER_STATS
+from profiling import PROFILER, ThreadSampler
+from utils import prepare_post_actions_field_map, apply_post_actions, apply_post_actions_batch
+
+LOG = logging.getLogger("root")
+# Number of items sent to a worker process at once
+DEF_CHUNK_SIZE = 10
+
+# Post action maps built by the worker process, by config key
+_WORKER_MAPS = {}
+# Samples the worker's stacks while it processes chunks, once the profiler asked for them
+_WORKER_SAMPLER = None
+
+
+def _init_worker(token_cache_size: int):
+    """Sets up a worker process"""
+    TOKEN_CACHE.resize(token_cache_size)
+
+
+def _get_worker_sampler(profile_interval: float = None) -> ThreadSampler:
+    """Returns the worker's stacks sampler, None if the chunks are not profiled"""
+    global _WORKER_SAMPLER
+    if profile_interval is None:
+        return None
+    if _WORKER_SAMPLER is None:
+        _WORKER_SAMPLER = ThreadSampler(profile_interval)
+    return _WORKER_SAMPLER
+
+
+def _apply_chunk(config_key: str, config: list, chunk: list,
+                 profile_interval: float = None) -> tuple:
+    """Apply chunk
+    Runs in a worker process. Applies the post actions on the chunk items, with the post action
+    map of the config, which is built once per worker.
+
+    Args:
+        config_key (str): Key of the post actions config
+        config (list): The post actions config (post_retrieval_actions)
+        chunk (list): Items
+        profile_interval (float, optional): Seconds between samples of the worker's stacks
+            while it processes the chunk. Defaults to None (not profiled).
+
+    Returns:
+        tuple: the altered items, (index, error) of the items which failed, the worker's
+            token cache and phone number pre-filter counters, and its sampled stacks
+    """
+    post_action_map = _WORKER_MAPS.get(config_key)
+    if post_action_map is None:
+        post_action_map = _WORKER_MAPS[config_key] = prepare_post_actions_field_map(config)
+
+    sampler = _get_worker_sampler(profile_interval)
+    errors = []
+    with sampler.sample() if sampler else nullcontext():
+        for index, item in enumerate(chunk):
+            try:
+                apply_post_actions(item, None, post_action_map)
+            except Exception as e:
+                errors.append((index, repr(e)))
+
+    stacks = sampler.drain() if sampler else None
+    return chunk, errors, TOKEN_CACHE.drain_counts(), PHONE_PREFILTER_STATS.drain(), stacks
+
+
+class PostActionsPool():
+    '''Post Actions Pool
+    Applies post actions with a pool of worker processes, so they run on all the cores instead
+    of one. Batches are split into chunks which are processed concurrently, and the altered
+    items are returned in their original order. Batches smaller than two chunks are not worth
+    the inter process traffic, so they are processed in process.
+    '''
+
+    def __init__(self, workers: int, chunk_size: int = DEF_CHUNK_SIZE,
+                 token_cache_size: int = None) -> None:
+        """
+        Args:
+            workers (int): Number of worker processes
+            chunk_size (int, optional): Items sent to a worker at once.
+                Defaults to DEF_CHUNK_SIZE.
+            token_cache_size (int, optional): Token cache size of each worker. Defaults to the
+                size of the main process cache.
+        """
+        self._chunk_size = max(chunk_size, 1)
+        if token_cache_size is None:
+            token_cache_size = TOKEN_CACHE.stats()['max_size']
+        # Workers are spawned rather than forked, as forking while source threads hold locks
+        # (like the token cache one) could leave them locked in the worker
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker,
+                                             initargs=(token_cache_size,))
+
+    def apply(self, results_batch: list, post_action_map: dict) -> list:
+        """Apply
+        Applies the post actions on the batch items
+
+        Args:
+            results_batch (list): Batch of items
+            post_action_map (dict): post action dict, as built by prepare_post_actions_field_map
+
+        Returns:
+            list: the altered items, in order
+        """
+        results_batch = list(results_batch)
+        if len(results_batch) < 2 * self._chunk_size:
+            return apply_post_actions_batch(results_batch, post_action_map)
+
+        chunks = [results_batch[i:i + self._chunk_size]
+                  for i in range(0, len(results_batch), self._chunk_size)]
+        profile_interval = PROFILER.interval if PROFILER.enabled else None
+        futures = [self._executor.submit(_apply_chunk, post_action_map['config_key'],
+                                         post_action_map['config'], chunk, profile_interval)
+                   for chunk in chunks]
+
+        altered = []
+        for chunk, future in zip(chunks, futures):
+            try:
+                items, errors, token_counts, prefilter_counters, stacks = future.result()
+            except Exception as e:
+                # The worker could not process the chunk (like a broken pool), so it is
+                # processed here instead
+                LOG.error('Got error while applying post actions in a worker process')
+                LOG.debug(e)
+                altered.extend(apply_post_actions_batch(chunk, post_action_map))
+                continue
+
+            for index, error in errors:
+                LOG.error('Could not apply post action on item')
+                LOG.debug(f"{items[index].get('id')}: {error}")
+            TOKEN_CACHE.add_counts(*token_counts)
+            PHONE_PREFILTER_STATS.merge(prefilter_counters)
+            PROFILER.add_stacks(stacks)
+            altered.extend(items)
+
+        return altered
+
+    def close(self):
+        """Shuts the worker processes down"""
+        self._executor.shutdown()
@@ -0,0 +1,333 @@
+import os
+import re
+import sys
+import time
+import logging
+import threading
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager
+from collections import Counter
+from concurrent.futures import thread as futures_thread
+
+LOG = logging.getLogger("root")
+# Seconds between two samples of the profiled threads' stacks
+DEF_SAMPLE_INTERVAL = 0.01
+# Number of hotspots (and memory allocation sites) logged per source
+DEF_TOP_N = 15
+# Frames kept for each memory allocation, more of them make tracing slower
+TRACEMALLOC_FRAMES = 1
+# Name prefix of the retrievers' worker threads, which are not registered with the profiler
+WORKER_THREAD_PREFIX = 'ThreadPoolExecutor'
+# Root frame of the stacks sampled in the post actions worker processes
+WORKER_PROCESS_FRAME = 'post actions worker process'
+
+
+class SamplingProfiler():
+    '''Sampling Profiler
+    Samples the stacks of every source's threads at a fixed interval from a background thread,
+    so the profiled code runs at full speed (unlike deterministic profilers which trace every
+    call). Samples are wall clock, so time waiting on the network or the DB shows up as well.
+
+    Threads are attributed to a source while they run profile_source, or once attached to it
+    (like the pipeline stage threads). Unattached retriever worker threads are attributed to
+    the only source being pulled, and left out when sources are pulled concurrently. Post
+    actions worker processes sample their own stacks while processing the source's chunks,
+    which are added to the source's profile under WORKER_PROCESS_FRAME.
+
+    For every source, writes its sampled stacks in the collapsed format read by flamegraph
+    tools (like flamegraph.pl or speedscope) and logs its top hotspots. With trace_memory,
+    also dumps a tracemalloc snapshot and logs the lines which allocated the most memory while
+    the source was pulled. Memory is traced process wide, so concurrent sources are mixed.
+
+    Until started, profiling sources does nothing.
+    '''
+
+    def __init__(self) -> None:
+        self._output_dir = None
+        self._interval = DEF_SAMPLE_INTERVAL
+        self._top = DEF_TOP_N
+        self._trace_memory = False
+        self._run = None
+        self._lock = threading.Lock()
+        # Thread ident -> (thread, source)
+        self._threads = {}
+        # Source -> Counter of collapsed stacks
+        self._stacks = {}
+        self._stop = threading.Event()
+        self._sampler = None
+
+    @property
+    def enabled(self) -> bool:
+        """True while sampling"""
+        return self._sampler is not None
+
+    @property
+    def interval(self) -> float:
+        """Seconds between samples"""
+        return self._interval
+
+    def start(self, output_dir: str, interval: float = DEF_SAMPLE_INTERVAL,
+              top: int = DEF_TOP_N, trace_memory: bool = False):
+        """Start
+        Starts sampling the profiled sources
+
+        Args:
+            output_dir (str): Directory of the profile files, created if missing
+            interval (float, optional): Seconds between samples. Defaults to
+                DEF_SAMPLE_INTERVAL.
+            top (int, optional): Number of hotspots logged per source. Defaults to DEF_TOP_N.
+            trace_memory (bool, optional): Also trace memory allocations. Defaults to False.
+        """
+        self._output_dir = output_dir
+        self._interval = interval
+        self._top = top
+        self._trace_memory = trace_memory
+        self._run = datetime.now().strftime('%Y%m%d-%H%M%S')
+        os.makedirs(self._output_dir, exist_ok=True)
+        if self._trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True,
+                                         name='profiler')
+        self._sampler.start()
+        LOG.info(f'Profiling sources every {self._interval * 1000:.0f} ms, '
+                 f'writing profiles to {self._output_dir}')
+
+    def stop(self):
+        """Stops sampling and tracing memory allocations"""
+        if not self.enabled:
+            return
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+        if self._trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def attach(self, source: str):
+        """Attributes the samples of the current thread to the source, until the thread ends"""
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        with self._lock:
+            self._threads[thread.ident] = (thread, source)
+
+    def detach(self):
+        """Stops attributing the samples of the current thread"""
+        with self._lock:
+            self._threads.pop(threading.get_ident(), None)
+
+    def add_stacks(self, stacks: Counter, root: str = WORKER_PROCESS_FRAME):
+        """Add stacks
+        Adds stacks sampled out of process to the profile of the current thread's source
+
+        Args:
+            stacks (Counter): Collapsed stacks and their samples
+            root (str, optional): Frame the stacks are added under. Defaults to
+                WORKER_PROCESS_FRAME.
+        """
+        if not self.enabled or not stacks:
+            return
+        with self._lock:
+            thread_source = self._threads.get(threading.get_ident())
+            if thread_source:
+                source = thread_source[1]
+            elif len(self._stacks) == 1:
+                source = next(iter(self._stacks))
+            else:
+                return
+            if source in self._stacks:
+                for stack, count in stacks.items():
+                    self._stacks[source][f'{root};{stack}'] += count
+
+    @contextmanager
+    def profile_source(self, source: str):
+        """Profile source
+        Profiles the source's threads while in the context, then writes its profile files and
+        logs its hotspots
+
+        Args:
+            source (str): Source name
+        """
+        if not self.enabled:
+            yield
+            return
+        with self._lock:
+            self._stacks[source] = Counter()
+        memory_start = self._take_snapshot()
+        self.attach(source)
+        try:
+            yield
+        finally:
+            self.detach()
+            with self._lock:
+                stacks = self._stacks.pop(source)
+            try:
+                path = self._write_stacks(source, stacks)
+                self._log_hotspots(source, stacks, path)
+                if memory_start is not None:
+                    self._write_memory(source, memory_start)
+            except Exception as e:
+                LOG.error(f'Got error while writing the profile of {source}')
+                LOG.debug(e)
+
+    def _sample_loop(self):
+        """Samples the stacks until stopped, keeping the interval between samples"""
+        while not self._stop.wait(self._interval):
+            try:
+                self._sample()
+            except Exception as e:
+                LOG.debug(e)
+
+    def _sample(self):
+        """Adds the current stack of every profiled thread to its source's stacks"""
+        frames = sys._current_frames()
+        with self._lock:
+            only_source = next(iter(self._stacks)) if len(self._stacks) == 1 else None
+            names = {thread.ident: thread.name for thread in threading.enumerate()} \
+                if only_source else {}
+            for ident, frame in frames.items():
+                thread_source = self._threads.get(ident)
+                if thread_source and thread_source[0].is_alive():
+                    source = thread_source[1]
+                elif thread_source:
+                    # The thread ended, and its ident may be reused by another one
+                    del self._threads[ident]
+                    continue
+                elif names.get(ident, '').startswith(WORKER_THREAD_PREFIX):
+                    # Idle workers wait for work in the worker loop itself
+                    if frame.f_code is futures_thread._worker.__code__:
+                        continue
+                    source = only_source
+                else:
+                    continue
+                if source in self._stacks:
+                    self._stacks[source][_collapse_stack(frame)] += 1
+
+    def _get_path(self, source: str, extension: str) -> str:
+        """Returns the path of a profile file of the source"""
+        name = re.sub(r'[^\w.-]', '_', source)
+        return os.path.join(self._output_dir, f'{name}-{self._run}.{extension}')
+
+    def _write_stacks(self, source: str, stacks: Counter) -> str:
+        """Writes the sampled stacks in the collapsed format (a stack and its count a line),
+        returns the file path"""
+        path = self._get_path(source, 'folded')
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in stacks.most_common():
+                file.write(f'{stack} {count}\n')
+        return path
+
+    def _log_hotspots(self, source: str, stacks: Counter, path: str):
+        """Logs the functions the source's threads were sampled in the most"""
+        samples = sum(stacks.values())
+        LOG.info(f'Profile of {source}: {samples} samples '
+                 f'(~{samples * self._interval:.1f} thread seconds), written to {path}')
+        if not samples:
+            return
+
+        own = Counter()
+        total = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        for frame, count in own.most_common(self._top):
+            LOG.info(f'{source} hotspot: {count / samples:6.1%} own, '
+                     f'{total[frame] / samples:6.1%} total - {frame}')
+
+    def _take_snapshot(self):
+        """Returns a snapshot of the traced memory allocations, None if not tracing"""
+        if not self._trace_memory or not tracemalloc.is_tracing():
+            return None
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>')))
+
+    def _write_memory(self, source: str, memory_start: tracemalloc.Snapshot):
+        """Dumps the memory snapshot at the end of the source, logs the top allocation sites"""
+        memory_end = self._take_snapshot()
+        if memory_end is None:
+            return
+        path = self._get_path(source, 'tracemalloc')
+        memory_end.dump(path)
+        current, peak = tracemalloc.get_traced_memory()
+        LOG.info(f'Memory of {source}: {current / 2 ** 20:.1f} MB traced, '
+                 f'{peak / 2 ** 20:.1f} MB peak, snapshot written to {path}')
+        for stat in memory_end.compare_to(memory_start, 'lineno')[:self._top]:
+            frame = stat.traceback[0]
+            LOG.info(f'{source} allocations: {stat.size_diff / 2 ** 20:+.2f} MB in '
+                     f'{stat.count_diff:+d} blocks - '
+                     f'{_get_short_path(frame.filename)}:{frame.lineno}')
+
+
+class ThreadSampler():
+    '''Thread Sampler
+    Samples the stacks of the thread which created it while it is in the sample context, like
+    a post actions worker process while it processes a chunk. The process which sent the chunk
+    adds the drained stacks to its source's profile.
+    '''
+
+    def __init__(self, interval: float = DEF_SAMPLE_INTERVAL) -> None:
+        self._interval = interval
+        self._ident = threading.get_ident()
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._active = threading.Event()
+        threading.Thread(target=self._sample_loop, daemon=True, name='profiler').start()
+
+    @contextmanager
+    def sample(self):
+        """Samples the thread while in the context"""
+        self._active.set()
+        try:
+            yield
+        finally:
+            self._active.clear()
+
+    def drain(self) -> Counter:
+        """Returns the stacks sampled so far, and resets them"""
+        with self._lock:
+            stacks, self._stacks = self._stacks, Counter()
+        return stacks
+
+    def _sample_loop(self):
+        while True:
+            self._active.wait()
+            time.sleep(self._interval)
+            frame = sys._current_frames().get(self._ident)
+            with self._lock:
+                if frame is not None and self._active.is_set():
+                    self._stacks[_collapse_stack(frame)] += 1
+
+
+_SHORT_PATHS = {}
+
+
+def _get_short_path(filename: str) -> str:
+    """Returns the file path relative to the import path it was loaded from"""
+    short_path = _SHORT_PATHS.get(filename)
+    if short_path is None:
+        roots = [root for root in sys.path if root and filename.startswith(root + os.sep)]
+        short_path = filename[len(max(roots, key=len)) + 1:] if roots else filename
+        _SHORT_PATHS[filename] = short_path
+    return short_path
+
+
+def _collapse_stack(frame) -> str:
+    """Returns the stack of the frame in the collapsed format, from the outermost call"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        name = getattr(code, 'co_qualname', code.co_name)
+        # Semicolons separate the frames, and the last space separates the count
+        frames.append(f'{name} ({_get_short_path(code.co_filename)}:{code.co_firstlineno})'
+                      .replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+PROFILER = SamplingProfiler()
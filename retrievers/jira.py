@@ -19,14 +19,38 @@ JiraSource:
     projects:
       - Project1
       - Project2
+    # Pull issues updated (instead of created) since the last run
+    # pull_by: updated
+    # Issues per page, up to the server maximum (default: 20)
+    # page_size: 100
+    # Number of pages fetched concurrently (default: 1)
+    # page_concurrency: 4
+    # Requests per minute allowed to the Jira host (default: only follow the rate limit headers)
+    # rate_limit: 300
+    # Issue fields and expands to request (default: all fields, with their rendered HTML)
+    # fields:
+    #   - summary
+    #   - created
+    # expand: []
 
 """
 
+import pytz
 import logging
 import requests
+import threading
 from time import time
 from datetime import datetime
+from dateutil.parser import isoparse
+from itertools import islice
+from collections import deque
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import DEFAULT_POOLSIZE
 from atlassian import Jira as _jira
+from utils import load_state
+from checkpoints import CheckpointBatch, resume_checkpoint, load_resume_position
+from .transport import create_session
 
 
 logger = logging.getLogger('main.retriever.Jira')
@@ -34,11 +58,33 @@ logger = logging.getLogger('main.retriever.Jira')
 # Number of items to batch fetch from Jira
 BATCH_SIZE = 20
 
+# Fields and expands requested by default. Custom field names are read from FIELDS_REQUEST,
+# so the names expand is not needed.
+DEFAULT_FIELDS = ['*all']
+DEFAULT_EXPAND = ['renderedFields']
+
 # JQL query for issue id retrieval
 INITIAL_REQUEST = (
-    "/rest/api/2/search?startAt={start}&maxResults={limit}&expand=names,renderedFields&fields=*all"
-    "&jql=project+IN+%28{projects}%29+AND+created%3E%3D{created}+order+by+created"
+    "/rest/api/2/search?startAt={start}&maxResults={limit}&expand={expand}&fields={fields}"
+    "&jql=project+IN+%28{projects}%29+AND+created%3E%3D%22{created}%22+order+by+created"
+)
+# JQL query for issues updated since a given minute. Newest first, so issues updated while
+# paging move to pages which were already read, instead of shifting unread issues out of reach.
+UPDATED_REQUEST = (
+    "/rest/api/2/search?startAt={start}&maxResults={limit}&expand={expand}&fields={fields}"
+    "&jql=project+IN+%28{projects}%29+AND+updated%3E%3D%22{updated}%22+order+by+updated+DESC"
 )
+USER_REQUEST = "/rest/api/2/myself"
+FIELDS_REQUEST = "/rest/api/2/field"
+
+# Custom field id -> name maps, by Jira url. Fetched once per run.
+FIELDS_MAPS = {}
+FIELDS_MAPS_LOCK = threading.Lock()
+
+PULL_BY_CREATED = 'created'
+PULL_BY_UPDATED = 'updated'
+# JQL dates are minute precise, and interpreted in the timezone of the user
+JQL_DATE_FORMAT = '%Y-%m-%d %H:%M'
 
 
 class Jira():
@@ -47,21 +93,36 @@ class Jira():
     """
 
     def __init__(self, source, start_time, ignore_deleted, credentials, projects=None,
-                 max_items=None):
+                 max_items=None, pull_by=PULL_BY_CREATED, fields=None, expand=None,
+                 page_size=BATCH_SIZE, page_concurrency=1, rate_limit=None, backfill=False):
+        # backfill (an explicit start time) needs no handling, as resume positions are kept
+        # per start time
         self._logger = logging.getLogger('root')
+        self._source = source
         self._ignore_deleted = ignore_deleted
         self._start_time = start_time
         self._credentials = credentials
         self._projects = projects or []
         self._max_items = max_items
+        if pull_by not in (PULL_BY_CREATED, PULL_BY_UPDATED):
+            raise ValueError(f'Unknown pull_by {pull_by}')
+        self._pull_by = pull_by
+        self._fields = DEFAULT_FIELDS if fields is None else fields
+        self._expand = DEFAULT_EXPAND if expand is None else expand
+        self._page_size = max(page_size, 1)
+        self._page_concurrency = max(page_concurrency, 1)
+        self._rate_limit = rate_limit
         self._jira = None
         self._init()
 
     def _init(self):
         """Initializes required variables"""
         self._jira = _jira(**self._credentials)
-        self._session = requests.Session()
-        self._session.auth = (self._credentials['username'], self._credentials['password'])
+        # Throttled (429) pages hold back all the pages in flight, and are retried
+        self._session = create_session(
+            auth=(self._credentials['username'], self._credentials['password']),
+            pool_size=max(self._page_concurrency, DEFAULT_POOLSIZE), rate_limit=self._rate_limit,
+            source=self._source)
 
     def get_item_ids(self):
         """Get Item IDs
@@ -93,36 +154,178 @@ class Jira():
         """Iterator for retrieving items from Jira projects"""
 
         projects = '%2C'.join(self._projects)
-        start_time = self._start_time.strftime('%Y-%m-%d')
-        item_index = 0
-        while True:
+        # An interrupted pull resumes from its last written page. Updated issues are pulled
+        # newest first, so issues updated meanwhile only move to pages which were read, and
+        # the page offset stays valid. Created issues are resumed from the last created time.
+        start = 0
+        timezone = None
+        if self._pull_by == PULL_BY_UPDATED:
+            started = time()
+            run = self._get_updated_since()
+            start = load_resume_position(self._source, run).get('start', 0)
+            request = UPDATED_REQUEST.replace('{updated}', quote(run))
+        else:
+            run = self._start_time.strftime('%Y-%m-%d')
+            timezone = self._get_user_timezone()
+            created = load_resume_position(self._source, run).get('created', run)
+            request = INITIAL_REQUEST.replace('{created}', quote(created))
+        request = request.replace('{expand}', quote(','.join(self._expand))) \
+            .replace('{fields}', quote(','.join(self._fields))) \
+            .replace('{projects}', projects)
+        fields_map = self._get_fields_map()
+
+        complete = False
+        with ThreadPoolExecutor(max_workers=self._page_concurrency) as pool:
+            for response in self._iter_pages(request, pool, start):
+                if not response.get('issues'):
+                    complete = True
+                    break
 
-            if self._max_items is not None and item_index >= self._max_items:
-                break
+                items_list = []
+                for item in response['issues']:
+                    # Without the fields metadata, use the names expand if it was requested
+                    if fields_map or response.get('names'):
+                        item = self.pre_parse_item(item, fields_map or response['names'])
+                    item['created_at'] = item.get('fields', {}).get('Created', '') or \
+                        item.get('fields', {}).get('created', '')
+                    item['title'] = item.get('fields', {}).get('Summary', '') or \
+                        item.get('fields', {}).get('summary', '')
+                    # TODO: Add proper check for deleted articles!
+                    item['deleted'] = False
+                    items_list.append(item)
 
-            url = self._credentials['url'] + INITIAL_REQUEST.format(
-                start=item_index, limit=BATCH_SIZE, created=start_time, projects=projects)
+                if self._pull_by == PULL_BY_UPDATED:
+                    position = {'start': response.get('startAt', 0) + len(response['issues'])}
+                else:
+                    position = self._get_created_position(items_list[-1], timezone)
+                yield CheckpointBatch(items_list,
+                                      position and resume_checkpoint(run, position))
 
-            response = self._get_url_json(url)
-            fields_map = response.get('names')
+        if complete and self._pull_by == PULL_BY_UPDATED:
+            # All the issues updated before this run started were pulled, saved once written
+            yield CheckpointBatch([], {'updated_high_water': started})
 
+    def _iter_pages(self, request: str, pool: ThreadPoolExecutor, first: int = 0):
+        """Iter Pages
+        Yields the search result pages in order, until an empty page or max_items. The first
+        page tells the total, so the following pages are fetched concurrently, with up to
+        page_concurrency requests in flight. Issues added meanwhile are fetched afterwards,
+        one page at a time.
+
+        Args:
+            request (str): Search request, formatted with the page start and limit
+            pool (ThreadPoolExecutor): Pool fetching the pages
+            first (int, optional): Offset of the first page. Defaults to 0.
+
+        Returns:
+            yields: Search responses
+        """
+        if self._max_items is not None and self._max_items <= 0:
+            return
+
+        response = self._get_page(request, first, self._page_size)
+        yield response
+        if not response.get('issues'):
+            return
+
+        # The server caps the page size, so the following pages start at its actual size
+        page_size = response.get('maxResults') or self._page_size
+        end = response.get('total', 0)
+        if self._max_items is not None:
+            end = min(end, first + self._max_items)
+
+        starts = iter(range(first + page_size, end, page_size))
+        pages = deque(pool.submit(self._get_page, request, start, page_size)
+                      for start in islice(starts, self._page_concurrency))
+        next_start = first + page_size
+        while pages:
+            response = pages.popleft().result()
+            yield response
             if not response.get('issues'):
-                break
-
-            items_list = []
-            for item in response['issues']:
-                if fields_map:
-                    item = self.pre_parse_item(item, fields_map)
-                item['created_at'] = item.get('fields', {}).get('Created', '') or \
-                    item.get('fields', {}).get('created', '')
-                item['title'] = item.get('fields', {}).get('Summary', '') or \
-                    item.get('fields', {}).get('summary', '')
-                # TODO: Add proper check for deleted articles!
-                item['deleted'] = False
-                items_list.append(item)
-
-            yield items_list
-            item_index += BATCH_SIZE
+                return
+            next_start += page_size
+            for start in islice(starts, 1):
+                pages.append(pool.submit(self._get_page, request, start, page_size))
+
+        while self._max_items is None or next_start < first + self._max_items:
+            response = self._get_page(request, next_start, page_size)
+            yield response
+            if not response.get('issues'):
+                return
+            next_start += page_size
+
+    def _get_page(self, request: str, start: int, limit: int) -> dict:
+        """Fetches a single search result page"""
+        return self._get_url_json(self._credentials['url'] + request.format(
+            start=start, limit=limit))
+
+    def _get_updated_since(self) -> str:
+        """Get Updated Since
+        Returns the JQL date to pull updated issues from: the start time, or the high-water
+        mark of the last complete run if it is earlier, so the issues updated since a failed
+        run are not skipped.
+
+        Returns:
+            str: JQL date, in the timezone of the Jira user
+        """
+        since = self._start_time.timestamp()
+        high_water = load_state(self._source).get('updated_high_water')
+        if high_water and high_water < since:
+            self._logger.info(f'Pulling {self._source} issues updated since the last complete run')
+            since = high_water
+
+        since = datetime.fromtimestamp(since, tz=pytz.utc)
+        return since.astimezone(self._get_user_timezone()).strftime(JQL_DATE_FORMAT)
+
+    @staticmethod
+    def _get_created_position(item: dict, timezone) -> dict:
+        """Get Created Position
+        Returns the position to resume a pull by created time from, after the item. JQL dates
+        are minute precise, so the issues created in the same minute are pulled again.
+
+        Args:
+            item (dict): The last pulled issue
+            timezone (tzinfo): Timezone of the Jira user
+
+        Returns:
+            dict: The position, None if the item has no created time
+        """
+        try:
+            created = isoparse(item['created_at'])
+        except Exception:
+            return None
+        return {'created': created.astimezone(timezone).strftime(JQL_DATE_FORMAT)}
+
+    def _get_fields_map(self) -> dict:
+        """Get Fields Map
+        Returns the custom field id -> name map of the Jira instance. It is fetched once per
+        run from the fields metadata, and shared by the sources of the same instance.
+
+        Returns:
+            dict: custom field id -> name, empty if the metadata could not be fetched
+        """
+        url = self._credentials['url']
+        with FIELDS_MAPS_LOCK:
+            if url not in FIELDS_MAPS:
+                try:
+                    fields = self._get_url_json(url + FIELDS_REQUEST)
+                    FIELDS_MAPS[url] = {field['id']: field['name'] for field in fields
+                                        if field.get('custom')}
+                except Exception as e:
+                    self._logger.warning('Could not get the Jira fields metadata')
+                    self._logger.debug(e)
+                    return {}
+            return FIELDS_MAPS[url]
+
+    def _get_user_timezone(self):
+        """Returns the timezone of the Jira user, which JQL dates are interpreted in"""
+        try:
+            user = self._get_url_json(self._credentials['url'] + USER_REQUEST)
+            return pytz.timezone(user['timeZone'])
+        except Exception as e:
+            self._logger.warning('Could not get the Jira user timezone, using UTC')
+            self._logger.debug(e)
+            return pytz.utc
 
     def get_new_fields(self, fields_list: list):
         """Pulls new fields for all existing items"""
@@ -0,0 +1,298 @@
+"""
+HTTP transport shared by the retrievers
+
+Retrievers get their sessions from create_session. A session keeps its connections alive in a
+pool sized for the retriever's concurrency, asks for gzip compressed responses, applies a
+default timeout, and retries connection errors and server errors with exponential backoff.
+
+Requests sent through a ThrottledAdapter share a Throttle per host. The throttle spreads the
+requests at the host's rate limit, configured per source (rate_limit, in requests per minute)
+and adapted to the rate limit headers of the responses. When a request is still answered with
+429 (Too Many Requests), every request to the same host waits for the Retry-After period
+before it is sent, instead of each worker hitting the rate limit on its own.
+
+Requests, retries, response bytes, durations and throttle sleeps are counted in the run metrics,
+labeled with the source of the session.
+"""
+import time
+import logging
+import threading
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from urllib3.util.retry import Retry
+from metrics import METRICS
+
+logger = logging.getLogger('root')
+
+# Seconds to wait on 429 responses without a usable Retry-After header
+DEFAULT_RETRY_AFTER = 1
+# Number of times a throttled request is resent before the 429 response is returned
+MAX_THROTTLED_RETRIES = 10
+# Seconds to wait for a connection, and for the server between response bytes
+DEFAULT_TIMEOUT = (10, 120)
+# Number of times a request is retried on connection errors and RETRY_STATUSES
+MAX_RETRIES = 5
+# Retries wait BACKOFF_FACTOR * 2 ** (retry - 1) seconds, or the response's Retry-After
+BACKOFF_FACTOR = 1
+# Transient server errors. 429 is handled by the throttle.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Rates are requests per minute
+RATE_LIMIT_WINDOW = 60
+# Rate limit headers of Zendesk, Jira and the IETF RateLimit draft
+RATE_LIMIT_HEADERS = ('x-rate-limit', 'x-ratelimit-limit', 'ratelimit-limit')
+RATE_REMAINING_HEADERS = ('x-rate-limit-remaining', 'x-ratelimit-remaining', 'ratelimit-remaining')
+RATE_FILL_HEADERS = ('x-ratelimit-fillrate',)
+RATE_INTERVAL_HEADERS = ('x-ratelimit-interval-seconds',)
+
+
+def get_retry_after(response, default: float = DEFAULT_RETRY_AFTER) -> float:
+    """Get Retry After
+    Returns the number of seconds to wait before retrying, as requested by the response
+    """
+    try:
+        return max(float(response.headers.get('retry-after')), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_header_number(headers, names: tuple) -> float:
+    """Returns the value of the first of the headers which holds a number, None if none does"""
+    for name in names:
+        try:
+            return float(headers[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+class Throttle():
+    '''Throttle
+    Retry-After gate and token bucket shared by all the requests sent to the same API.
+
+    Requests take a token from the bucket before they are sent, so they are spread evenly at
+    the allowed rate instead of bursting into 429 responses. The rate is the configured one,
+    lowered to the quota the API reports in its rate limit headers. Without either, requests
+    are not limited.
+    '''
+
+    def __init__(self, rate: float = None) -> None:
+        """
+        Args:
+            rate (float, optional): Requests per minute. Defaults to None (no limit).
+        """
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+        self._configured_rate = rate
+        self._reported_rate = None
+        self._capacity = None
+        self._rate = None
+        self._tokens = 0.0
+        self._updated_at = time.monotonic()
+        self._set_rate()
+
+    def configure(self, rate: float):
+        """Configure
+        Limits the requests per minute. The lowest configured rate is kept, as the quota is
+        shared by all the sources using the API.
+        """
+        with self._lock:
+            if self._configured_rate is None or rate < self._configured_rate:
+                self._configured_rate = rate
+                self._set_rate()
+
+    def wait(self) -> float:
+        """Wait
+        Blocks until the API accepts requests again, and takes a token
+
+        Returns:
+            float: Seconds the request was held back
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+                if delay <= 0:
+                    delay = self._take_token()
+            if delay <= 0:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def block(self, seconds: float):
+        """Block
+        Holds back all the requests for the given number of seconds
+        """
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def update(self, headers):
+        """Update
+        Adapts the rate to the quota reported by the API response headers. Supports the
+        Zendesk (X-Rate-Limit), Jira (X-RateLimit-*) and standard (RateLimit-*) headers.
+        """
+        limit = get_header_number(headers, RATE_LIMIT_HEADERS)
+        remaining = get_header_number(headers, RATE_REMAINING_HEADERS)
+        fill_rate = get_header_number(headers, RATE_FILL_HEADERS)
+        interval = get_header_number(headers, RATE_INTERVAL_HEADERS) or RATE_LIMIT_WINDOW
+
+        with self._lock:
+            if fill_rate:
+                # Jira refills fill_rate tokens every interval, up to limit
+                reported_rate = fill_rate * RATE_LIMIT_WINDOW / interval
+            elif limit:
+                reported_rate = limit * RATE_LIMIT_WINDOW / interval
+            else:
+                reported_rate = None
+
+            if reported_rate and reported_rate != self._reported_rate:
+                self._reported_rate = reported_rate
+                self._set_rate()
+            if remaining is not None and self._rate:
+                # Other clients may use the same quota
+                self._tokens = min(self._tokens, remaining)
+
+    def _set_rate(self):
+        """Sets the bucket rate and capacity, under the lock"""
+        rates = [x for x in (self._configured_rate, self._reported_rate) if x]
+        limited = self._rate
+        self._rate = min(rates) if rates else None
+        if self._rate:
+            # Allows bursts of a second worth of requests
+            self._capacity = max(self._rate / RATE_LIMIT_WINDOW, 1.0)
+            if not limited:
+                # The bucket starts full
+                self._tokens = self._capacity
+                self._updated_at = time.monotonic()
+            self._tokens = min(self._tokens, self._capacity)
+
+    def _take_token(self) -> float:
+        """Takes a token under the lock, returns the seconds to wait if none is left"""
+        if not self._rate:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._updated_at) * self._rate / RATE_LIMIT_WINDOW)
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) * RATE_LIMIT_WINDOW / self._rate
+
+
+# Throttles of the hosts, shared by all the sessions
+THROTTLES = {}
+THROTTLES_LOCK = threading.Lock()
+
+
+def get_throttle(host: str, rate: float = None) -> Throttle:
+    """Get Throttle
+    Returns the throttle shared by all the requests to the host
+
+    Args:
+        host (str): Host (and port)
+        rate (float, optional): Requests per minute allowed to the host. Defaults to None.
+
+    Returns:
+        Throttle: The host throttle
+    """
+    with THROTTLES_LOCK:
+        if host not in THROTTLES:
+            THROTTLES[host] = Throttle()
+        throttle = THROTTLES[host]
+    if rate:
+        throttle.configure(rate)
+    return throttle
+
+
+class ThrottledAdapter(HTTPAdapter):
+    '''Throttled Adapter
+    HTTP adapter which waits on a shared Throttle and resends throttled (429) requests. Without
+    a throttle, requests wait on the throttle of their host.
+    '''
+
+    def __init__(self, throttle: Throttle = None, timeout=None, rate_limit: float = None,
+                 source: str = None, **kwargs) -> None:
+        self._throttle = throttle
+        self._timeout = timeout
+        self._rate_limit = rate_limit
+        self._source = source or ''
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """Sends the request, waiting for the throttle and retrying on 429 responses"""
+        throttle = self._throttle or get_throttle(urlsplit(request.url).netloc, self._rate_limit)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._timeout
+
+        for attempt in range(MAX_THROTTLED_RETRIES):
+            waited = throttle.wait()
+            if waited:
+                METRICS.inc('throttle_sleeps_total', source=self._source)
+                METRICS.inc('throttle_sleep_seconds_total', waited, source=self._source)
+            if attempt:
+                METRICS.inc('http_retries_total', source=self._source)
+
+            with METRICS.timer('http_request_seconds', source=self._source):
+                response = super().send(request, **kwargs)
+            self._count_response(response, kwargs.get('stream'))
+            throttle.update(response.headers)
+            if response.status_code != 429:
+                return response
+
+            retry_after = get_retry_after(response)
+            logger.debug('Throttled by %s, holding requests for %s seconds',
+                         request.url, retry_after)
+            throttle.block(retry_after)
+            response.close()
+
+        return response
+
+    def _count_response(self, response, stream: bool = False):
+        """Counts the response, and the retries of connection and server errors before it"""
+        retries = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+        METRICS.inc('http_requests_total', len(retries) + 1, source=self._source)
+        METRICS.inc('http_retries_total', len(retries), source=self._source)
+        try:
+            # Compressed responses are counted as received
+            size = int(response.headers['content-length'])
+        except (KeyError, TypeError, ValueError):
+            size = 0 if stream else len(response.content)
+        METRICS.inc('http_response_bytes_total', size, source=self._source)
+
+
+def create_session(auth: tuple = None, pool_size: int = DEFAULT_POOLSIZE,
+                   timeout=DEFAULT_TIMEOUT, max_retries: int = MAX_RETRIES,
+                   rate_limit: float = None, source: str = None) -> requests.Session:
+    """Create Session
+    Returns a session whose requests are pooled, compressed, retried, and throttled per host
+
+    Args:
+        auth (tuple, optional): (username, password). Defaults to None.
+        pool_size (int, optional): Connections kept alive per host, at least the number of
+            concurrent requests. Defaults to DEFAULT_POOLSIZE.
+        timeout (optional): Default (connect, read) timeout in seconds. Defaults to
+            DEFAULT_TIMEOUT.
+        max_retries (int, optional): Retries on connection and server errors. Defaults to
+            MAX_RETRIES.
+        rate_limit (float, optional): Requests per minute allowed to each host the session
+            sends requests to. Defaults to None (only the rate limit headers are followed).
+        source (str, optional): Source name, which the session's metrics are labeled with.
+
+    Returns:
+        requests.Session: The session
+    """
+    retry = Retry(total=max_retries, backoff_factor=BACKOFF_FACTOR,
+                  status_forcelist=RETRY_STATUSES, respect_retry_after_header=True,
+                  raise_on_status=False)
+    adapter = ThrottledAdapter(timeout=timeout, rate_limit=rate_limit, source=source,
+                               max_retries=retry, pool_connections=pool_size,
+                               pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.auth = auth
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
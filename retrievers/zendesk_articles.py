@@ -10,17 +10,27 @@ ArticleSource:
     credentials:
       username: <USERNAME>
       password: <PASSWORD>
+    breadcrumbs_ttl: 86400
+    breadcrumbs_cache: breadcrumbs_cache.json
+    deleted_full_sync_interval: 604800
+    rate_limit: 400
 
 """
 import time
+import json
 import logging
-import requests
 
 from datetime import datetime
-from utils import set_deleted
+from utils import set_deleted, update_deleted, load_state, save_state, PULL_TIME_DELTA_MINS
+from checkpoints import CheckpointBatch, resume_checkpoint, load_resume_position
+from .transport import create_session
 
 logger = logging.getLogger('main')
 DEF_SOURCE = 'ArticleSource'
+# Seconds the sections breadcrumbs are kept before they are fetched again
+DEF_BREADCRUMBS_TTL = 24 * 60 * 60
+# Seconds between full deleted articles syncs. In between, only changed articles are synced.
+DEF_DELETED_FULL_SYNC_INTERVAL = 7 * 24 * 60 * 60
 
 
 class ZendeskArticles():
@@ -28,13 +38,19 @@ class ZendeskArticles():
     Retriever
     """
 
-    # ARTICLES_API = 'https://{}.zendesk.com/api/v2/help_center/incremental/articles.json?{}'
+    INCREMENTAL_ARTICLES_API = \
+        'https://{}.zendesk.com/api/v2/help_center/incremental/articles.json?{}'
     ARTICLES_API = 'https://{}.zendesk.com/api/v2/help_center/{}/articles.json?{}'
     CATEGORIES_API = 'https://{}.zendesk.com/api/v2/help_center/categories.json'
     SECTIONS_API = 'https://{}.zendesk.com/api/v2/help_center/sections.json'
 
     def __init__(self, source: str, start_time: datetime, ignore_deleted: bool,
-                 subdomain: str, locale: str, credentials: dict, max_items: int = None):
+                 subdomain: str, locale: str, credentials: dict, max_items: int = None,
+                 breadcrumbs_ttl: int = DEF_BREADCRUMBS_TTL, breadcrumbs_cache: str = None,
+                 deleted_full_sync_interval: int = DEF_DELETED_FULL_SYNC_INTERVAL,
+                 rate_limit: int = None, backfill: bool = False):
+        # backfill (an explicit start time) needs no handling, as resume positions are kept
+        # per start time
         self._ignore_deleted = ignore_deleted
         self._start_time = start_time
         self._subdomain = subdomain
@@ -43,19 +59,31 @@ class ZendeskArticles():
         self._credentials = credentials
         self._max_items = max_items
         self._url = None
+        self._run = None
         self._session = None
         self._page_count = 0
         self._total = 0
         self._items: list = []
+        self._breadcrumbs_ttl = breadcrumbs_ttl
+        self._breadcrumbs_cache = breadcrumbs_cache
+        self._breadcrumbs: dict = {}
+        self._breadcrumbs_time = 0.0
+        self._missing_sections: set = set()
+        self._deleted_full_sync_interval = deleted_full_sync_interval
+        self._rate_limit = rate_limit
         self._init()
 
     def _init(self):
         """Initializes required variables"""
         attrs = f"start_time={self._start_time.strftime('%s')}"
         self._url = self.ARTICLES_API.format(self._subdomain, self._locale, attrs)
+        # An interrupted pull resumes from the page after its last written one
+        self._run = self._start_time.strftime('%s')
+        self._url = load_resume_position(self._source, self._run).get('url', self._url)
         logger.info("Using API URL: '%s'", self._url)
-        self._session = requests.Session()
-        self._session.auth = (self._credentials['username'], self._credentials['password'])
+        self._session = create_session(
+            auth=(self._credentials['username'], self._credentials['password']),
+            rate_limit=self._rate_limit, source=self._source)
 
     def get_item_ids(self) -> list:
         """Get Item IDs
@@ -81,27 +109,84 @@ class ZendeskArticles():
             raise StopIteration
 
         # Retrieves page from zendesk api:
-        response = self._session.get(self._url)
-        if response.status_code != 200:
-            print('Failed to retrieve articles with error {}'.format(response.status_code))
-            exit()
-
-        data = response.json()
-        # Retrieves sections for breadcrumbs:
-        sections = self._get_breadcrumbs()
+        data = self._get_page_from_url(self._url).json()
         self._items = data.get('articles', [])
         self._total += len(self._items)
         for item in self._items:
-            item['breadcrumbs'] = sections[item['section_id']]
+            item['breadcrumbs'] = self._get_section_breadcrumbs(item['section_id'])
             item['deleted'] = False
 
         self._url = data.get('next_page')
-        return self._items
+        checkpoint = resume_checkpoint(self._run, {'url': self._url}) if self._url else None
+        return CheckpointBatch(self._items, checkpoint)
 
     def get_new_fields(self, fields_list: list):
         """Pulls new fields for all existing items"""
         pass
 
+    def _get_section_breadcrumbs(self, section_id) -> str:
+        """Get Section Breadcrumbs
+        Returns the breadcrumbs of a section from the breadcrumbs cache. The cache is loaded
+        once, and refreshed when it expires or when an article refers to an unknown section.
+
+        Args:
+            section_id (int): Article's section ID.
+
+        Returns:
+            str: Section breadcrumbs, empty if the section doesn't exist.
+        """
+        if time.time() - self._breadcrumbs_time > self._breadcrumbs_ttl:
+            self._load_breadcrumbs()
+
+        key = str(section_id)
+        if key not in self._breadcrumbs and key not in self._missing_sections:
+            logger.debug('Unknown section %s, refreshing breadcrumbs', section_id)
+            self._refresh_breadcrumbs()
+            if key not in self._breadcrumbs:
+                logger.warning('Section %s was not found, using empty breadcrumbs', section_id)
+                self._missing_sections.add(key)
+
+        return self._breadcrumbs.get(key, '')
+
+    def _load_breadcrumbs(self):
+        """Load Breadcrumbs
+        Loads the breadcrumbs from the cache file if it is fresh, otherwise fetches them.
+        Sections found missing before are looked up again.
+        """
+        self._missing_sections = set()
+        if self._breadcrumbs_cache:
+            try:
+                with open(self._breadcrumbs_cache, 'r', encoding='utf-8') as file:
+                    cache = json.load(file)
+                if time.time() - cache['time'] <= self._breadcrumbs_ttl:
+                    self._breadcrumbs = cache['breadcrumbs']
+                    self._breadcrumbs_time = cache['time']
+                    logger.debug('Loaded breadcrumbs from %s', self._breadcrumbs_cache)
+                    return
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning('Could not read breadcrumbs cache %s', self._breadcrumbs_cache)
+                logger.debug(e)
+
+        self._refresh_breadcrumbs()
+
+    def _refresh_breadcrumbs(self):
+        """Refresh Breadcrumbs
+        Fetches the breadcrumbs from the API and saves them to the cache file.
+        """
+        self._breadcrumbs = {str(k): v for k, v in self._get_breadcrumbs().items()}
+        self._breadcrumbs_time = time.time()
+
+        if self._breadcrumbs_cache:
+            try:
+                with open(self._breadcrumbs_cache, 'w', encoding='utf-8') as file:
+                    json.dump({'time': self._breadcrumbs_time, 'breadcrumbs': self._breadcrumbs},
+                              file)
+            except Exception as e:
+                logger.warning('Could not write breadcrumbs cache %s', self._breadcrumbs_cache)
+                logger.debug(e)
+
     def _get_breadcrumbs(self):
         """Get Sections
         Retrieves breadcrumbs for articles using retrieved sections.
@@ -118,7 +203,8 @@ class ZendeskArticles():
             data = response.json()
             sections.extend(data.get('sections', []))
             url = data.get('next_page')
-        sections = {x["id"]: f"{categories[x['category_id']]} > {x['name']}" for x in sections}
+        sections = {
+            x["id"]: f"{categories.get(x['category_id'], '')} > {x['name']}" for x in sections}
         logger.debug('Retrieved categories:\n%s', sections)
         return sections
 
@@ -146,29 +232,39 @@ class ZendeskArticles():
         return categories
 
     def _get_page_from_url(self, url):
-        """Returns next items page from API"""
+        """Returns next items page from API. Throttled requests and transient errors are
+        retried by the session, other errors are raised."""
         logger.debug('Fetching page %s', url)
-        response = None
-        while url:
-            response = self._session.get(url)
-            if response.status_code == 200:
-                break
-
-            if response.status_code != 429:
-                logger.warn("Received status code %s (not 200 or 429):\n%s",
-                            response.status_code, response)
-                print(response.__dict__)
-            # if response.status_code != 429:
-            #     break
-            # Retry in case of blocked
-            logger.debug('Had to sleep for %s', response.headers.get('retry-after', None))
-            time.sleep(int(response.headers.get('retry-after', 1)))
+        response = self._session.get(url)
+        response.raise_for_status()
         return response
 
     def _sync_deleted(self):
         """Sync Deleted
+        Syncs the deleted attribute of the source articles. Runs a full sync when none was run
+        for deleted_full_sync_interval seconds, otherwise only syncs the articles which changed
+        since the last sync.
+        """
+        state = load_state(self._source)
+        sync_time = int(time.time())
+        last_sync_time = state.get('deleted_sync_time')
+        last_full_sync_time = state.get('deleted_full_sync_time', 0)
+
+        if not last_sync_time or \
+                sync_time - last_full_sync_time >= self._deleted_full_sync_interval:
+            if self._sync_all_deleted():
+                save_state(self._source, {'deleted_sync_time': sync_time,
+                                          'deleted_full_sync_time': sync_time})
+        elif self._sync_changed_deleted(last_sync_time - PULL_TIME_DELTA_MINS * 60):
+            save_state(self._source, {'deleted_sync_time': sync_time})
+
+    def _sync_all_deleted(self) -> bool:
+        """Sync All Deleted
         Filters all articles that are not in the _all_article_ids set and sets their
         deleted attribute to True.
+
+        Returns:
+            bool: True if the deleted articles were updated.
         """
         logger.info("Retrieving deleted articles...")
         start_time = datetime(2019, 1, 1)
@@ -185,4 +281,32 @@ class ZendeskArticles():
 
         # Takes all articles and excludes articles in the _all_article_ids set and sets these
         # to deleted=True:
-        set_deleted(articles, self._source)
+        return set_deleted(articles, self._source)
+
+    def _sync_changed_deleted(self, start_time: int) -> bool:
+        """Sync Changed Deleted
+        Retrieves the articles which changed since start_time from the incremental articles
+        endpoint, and sets the deleted attribute of draft articles to True and of the others
+        to False.
+
+        Args:
+            start_time (int): Unix time of the oldest change to sync.
+
+        Returns:
+            bool: True if the deleted articles were updated.
+        """
+        logger.info("Retrieving changed articles...")
+        url = self.INCREMENTAL_ARTICLES_API.format(self._subdomain, f"start_time={start_time}")
+
+        articles = {}
+        while url:
+            response = self._get_page_from_url(url)
+            data = response.json()
+            articles.update((a['id'], a['draft']) for a in data.get('articles', []))
+            next_page = data.get('next_page')
+            # Incremental endpoints keep returning the last page once the end is reached
+            url = next_page if data.get('articles') and next_page != url else None
+
+        if not articles:
+            return True
+        return update_deleted(articles, self._source)
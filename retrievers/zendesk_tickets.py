@@ -10,20 +10,66 @@ ZendeskSource:
       email: <USERNANE>
       token: <TOKEN>
       subdomain: d3v-xfind
+    comments_concurrency: 8
+    rate_limit: 400
+    export_mode: true
+    export_include:
+      - users
+      - groups
+      - organizations
+      - brands
+    ticket_attributes:
+      - id
+      - subject
+      - description
+      - status
+      - created_at
+      - requester
+      - custom_fields
+      - fields
 
 """
 import os
-import json
 import logging
 from datetime import datetime
+from dateutil.parser import isoparse
 from zenpy import Zenpy
+from zenpy.lib.api_objects import BaseObject
 from typing import Generator
+from requests.adapters import DEFAULT_POOLSIZE
+from concurrent.futures import ThreadPoolExecutor
+from zenpy.lib.response import GenericZendeskResponseHandler
+from utils import load_state
+from checkpoints import CheckpointBatch, resume_checkpoint, load_resume_position
+from .transport import create_session
 
 
 logger = logging.getLogger('root')
 
 
 COMMENT_FIELDS = ["author_id", "body", "id", "public", "type", "created_at"]
+# Number of tickets per comments worker whose comments are fetched together
+COMMENTS_WINDOW_PER_WORKER = 4
+
+# Cursor based incremental tickets export
+EXPORT_API = 'https://{}/api/v2/incremental/tickets/cursor.json'
+# Related objects side-loaded with each tickets page, so ticket attributes are read from cache
+DEF_EXPORT_INCLUDE = ['users', 'groups', 'organizations', 'brands']
+
+# Related objects of the ticket, read from the side-loaded objects cache (never requested):
+# attribute -> (id attribute, object type)
+TICKET_RELATIONS = {
+    'assignee': ('assignee_id', 'user'),
+    'requester': ('requester_id', 'user'),
+    'submitter': ('submitter_id', 'user'),
+    'group': ('group_id', 'group'),
+    'organization': ('organization_id', 'organization'),
+    'brand': ('brand_id', 'brand'),
+}
+# Ticket dates, parsed from their ISO 8601 attribute: attribute -> source attribute
+TICKET_DATES = {'created': 'created_at', 'updated': 'updated_at', 'due': 'due_at'}
+# Zenpy bookkeeping attributes, which are not part of the ticket JSON
+ZENPY_ATTRIBUTES = ('api', '_dirty_attributes', '_always_dirty', '_dirty_callback', '_dirty')
 
 
 class ZendeskTickets():
@@ -32,12 +78,23 @@ class ZendeskTickets():
     """
 
     def __init__(self, source: str, start_time: datetime, ignore_deleted: bool = True,
-                 credentials: dict = {}, max_items: int = None):
+                 credentials: dict = {}, max_items: int = None, comments_concurrency: int = 1,
+                 export_mode: bool = False, export_include: list = None, rate_limit: int = None,
+                 ticket_attributes: list = None, backfill: bool = False):
         #super().__init__(source, update_record, ignore_deleted)
+        self._source = source
         self._ignore_deleted = ignore_deleted
         self._start_time = start_time
+        # The start time was given explicitly, rather than from the last pull
+        self._backfill = backfill
         self._credentials = credentials
         self._max_items = max_items
+        self._comments_concurrency = max(comments_concurrency or 1, 1)
+        self._export_mode = export_mode
+        self._export_include = DEF_EXPORT_INCLUDE if export_include is None else export_include
+        self._rate_limit = rate_limit
+        self._ticket_attributes = None if ticket_attributes is None else set(ticket_attributes)
+        self._session = None
         self._client = None
         self._init()
 
@@ -46,7 +103,11 @@ class ZendeskTickets():
         # Should be either:
         # {email: email, token: token, subdomain: subdomain} OR
         # {email: email, password: password, subdomain: subdomain}
-        self._client = Zenpy(**self._credentials)
+        # All the requests share the host's throttle, so a 429 holds back every comments worker
+        self._session = create_session(
+            pool_size=max(self._comments_concurrency, DEFAULT_POOLSIZE),
+            rate_limit=self._rate_limit, source=self._source)
+        self._client = Zenpy(session=self._session, **self._credentials)
 
     def get_item_ids(self) -> Generator:
         """Get Item IDs
@@ -63,8 +124,40 @@ class ZendeskTickets():
 
         # Retrieves ticket custom fields:
         ticket_fields = self._get_ticket_fields()
-        tickets = self._client.tickets.incremental(start_time=self._start_time.strftime('%s'))
 
+        if self._export_mode:
+            yield from self._iter_export(ticket_fields)
+            return
+
+        # An interrupted pull resumes from the last written ticket
+        run = int(self._start_time.timestamp())
+        start_time = load_resume_position(self._source, run).get('generated_timestamp') or run
+        tickets = self._client.tickets.incremental(start_time=start_time,
+                                                   include=','.join(self._export_include) or None)
+
+        if self._comments_concurrency > 1:
+            yield from self._iter_concurrent_comments(tickets, ticket_fields, run)
+            return
+
+        for ticket, tmp in self._iter_ticket_attributes(tickets, ticket_fields):
+            tmp['comments'] = self._get_ticket_comments(ticket.id)
+
+            # Checks if deleted:
+            tmp['deleted'] = (ticket.status == 'deleted')
+
+            yield CheckpointBatch([tmp], self._get_resume_checkpoint(run, [ticket]))
+
+    def _iter_ticket_attributes(self, tickets, ticket_fields: dict) -> Generator:
+        """Iter Ticket Attributes
+        Yields the tickets to pull along with their attributes and custom fields.
+
+        Arguments:
+            tickets {Iterable} -- Zenpy tickets.
+            ticket_fields {dict} -- Ticket fields dictionary.
+
+        Returns:
+            yields: (Zenpy.Ticket, dict) tuples.
+        """
         for i, ticket in enumerate(tickets):
 
             # Stop if reached max items:
@@ -76,12 +169,137 @@ class ZendeskTickets():
 
             tmp = self._get_ticket_attributes(ticket)
             tmp = self._get_custom_fields(tmp, ticket_fields)
-            tmp['comments'] = self._get_ticket_comments(ticket.id)
+            yield ticket, tmp
+
+    def _iter_concurrent_comments(self, tickets, ticket_fields: dict, run: int) -> Generator:
+        """Iter Concurrent Comments
+        Fetches the comments of a window of tickets concurrently, and yields each window as a
+        batch in the tickets order.
+
+        Arguments:
+            tickets {Iterable} -- Zenpy tickets.
+            ticket_fields {dict} -- Ticket fields dictionary.
+            run {int} -- Start time of the pull, identifying its checkpoints.
+
+        Returns:
+            yields: List of tickets.
+        """
+        window_size = self._comments_concurrency * COMMENTS_WINDOW_PER_WORKER
+        window = []
+        with ThreadPoolExecutor(max_workers=self._comments_concurrency) as pool:
+            for ticket, tmp in self._iter_ticket_attributes(tickets, ticket_fields):
+                window.append((ticket, tmp))
+                if len(window) >= window_size:
+                    yield CheckpointBatch(self._add_comments(window, pool),
+                                          self._get_resume_checkpoint(run, window))
+                    window = []
+
+            if window:
+                yield CheckpointBatch(self._add_comments(window, pool),
+                                      self._get_resume_checkpoint(run, window))
+
+    @staticmethod
+    def _get_resume_checkpoint(run: int, tickets: list) -> dict:
+        """Get Resume Checkpoint
+        Returns the checkpoint of a batch of the incremental export, which is ordered by the
+        tickets generated_timestamp. Resuming from the latest one pulls the tickets sharing it
+        again, rather than skipping them.
+
+        Arguments:
+            run {int} -- Start time of the pull.
+            tickets {list} -- Zenpy tickets, or (Zenpy.Ticket, dict) tuples.
+
+        Returns:
+            dict -- The checkpoint, None if the tickets have no generated_timestamp.
+        """
+        tickets = [t[0] if isinstance(t, tuple) else t for t in tickets]
+        timestamps = [getattr(t, 'generated_timestamp', None) or 0 for t in tickets]
+        if not any(timestamps):
+            return None
+        return resume_checkpoint(run, {'generated_timestamp': max(timestamps)})
+
+    def _iter_export(self, ticket_fields: dict) -> Generator:
+        """Iter Export
+        Walks the cursor based incremental tickets export and yields every page as a batch.
+        The cursor of the next page is the checkpoint of the batch, saved once the page was
+        written, so the next run resumes exactly where this one stopped.
+
+        Arguments:
+            ticket_fields {dict} -- Ticket fields dictionary.
+
+        Returns:
+            yields: List of tickets.
+        """
+        handler = GenericZendeskResponseHandler(self._client.tickets)
+        url = EXPORT_API.format(self._client.tickets.base_url)
+        params = self._get_export_params()
+        total = 0
+
+        with ThreadPoolExecutor(max_workers=self._comments_concurrency) as pool:
+            while True:
+                response = self._session.get(url, params=params)
+                response.raise_for_status()
+                data = response.json()
+
+                # Deserializing the page caches the side-loaded objects
+                tickets = handler.deserialize(data).get('tickets', [])
+                if self._max_items is not None:
+                    tickets = tickets[:max(self._max_items - total, 0)]
+                total += len(tickets)
+
+                window = [(ticket, tmp) for ticket, tmp in
+                          self._iter_ticket_attributes(tickets, ticket_fields)]
+
+                state = {'export_cursor': data.get('after_cursor')}
+                timestamps = [getattr(t, 'generated_timestamp', None) or 0 for t in tickets]
+                if any(timestamps):
+                    state['export_time'] = max(timestamps)
+                # Pages without tickets to pull are still yielded, to move the cursor forward
+                yield CheckpointBatch(self._add_comments(window, pool) if window else [],
+                                      state if state['export_cursor'] else None)
+
+                if data.get('end_of_stream') or not data.get('after_cursor') or \
+                        (self._max_items is not None and total >= self._max_items):
+                    break
+                params = {'cursor': data['after_cursor'], 'include': params.get('include')}
+
+    def _get_export_params(self) -> dict:
+        """Get Export Params
+        Resumes exactly from the saved export cursor, unless the start time was given
+        explicitly (a --starttime backfill).
+
+        Returns:
+            dict -- Query params of the first export page.
+        """
+        params = {'include': ','.join(self._export_include) or None}
+        state = load_state(self._source)
+        if state.get('export_cursor') and not self._backfill:
+            logger.info('Resuming tickets export from saved cursor')
+            params['cursor'] = state['export_cursor']
+        else:
+            params['start_time'] = self._start_time.strftime('%s')
+        return params
+
+    def _add_comments(self, window: list, pool: ThreadPoolExecutor) -> list:
+        """Add Comments
+        Adds comments to a window of tickets, fetching them with the workers pool.
+
+        Arguments:
+            window {list} -- (Zenpy.Ticket, dict) tuples.
+            pool {ThreadPoolExecutor} -- Comments workers pool.
+
+        Returns:
+            list of dict -- Tickets with their comments.
+        """
+        ids = [ticket.id for ticket, _ in window]
+        results = []
+        for (ticket, tmp), comments in zip(window, pool.map(self._get_ticket_comments, ids)):
+            tmp['comments'] = comments
 
             # Checks if deleted:
             tmp['deleted'] = (ticket.status == 'deleted')
-
-            yield [tmp]
+            results.append(tmp)
+        return results
 
     def get_new_fields(self, fields_list: list):
         """Pulls new fields for all existing items"""
@@ -122,10 +340,11 @@ class ZendeskTickets():
             pass
         return comments
 
-    @staticmethod
-    def _get_ticket_attributes(obj):
+    def _get_ticket_attributes(self, obj):
         """Get Ticket Attributes
-        Pulls ticket data into dictionary including all attributes that contain to_dict method.
+        Converts the ticket into a dictionary in one pass, from the attributes of its JSON.
+        Related users, groups, organizations and brands are read from the side-loaded objects
+        cache, so no request is made per ticket. Only the ticket_attributes are kept, if set.
 
         Arguments:
             obj {Zenpy.Ticket} -- Ticket object.
@@ -133,15 +352,26 @@ class ZendeskTickets():
         Returns:
             dict -- Ticket as a dictionary.
         """
+        allowed = self._ticket_attributes
         ticket = {}
-        for attr in [a for a in dir(obj) if not a.startswith('_')]:
-            try:
-                value = getattr(obj, attr, None)
-                todict = getattr(value, 'to_dict', None)
-                ticket[attr] = todict() if todict else value
-            except Exception:
-                ticket[attr] = "xFind: Error retrieving object"
-        ticket = json.loads(json.dumps(ticket, default=str))
+        for attr, value in vars(obj).items():
+            if attr in ZENPY_ATTRIBUTES:
+                continue
+            # Zenpy prefixes the attributes named like reserved words with an underscore
+            attr = attr[1:] if attr.startswith('_') else attr
+            if allowed is None or attr in allowed:
+                ticket[attr] = _to_json(value)
+
+        for attr, source_attr in TICKET_DATES.items():
+            if allowed is None or attr in allowed:
+                value = getattr(obj, source_attr, None)
+                ticket[attr] = str(isoparse(value)) if value else None
+
+        for attr, (id_attr, object_type) in TICKET_RELATIONS.items():
+            if allowed is None or attr in allowed:
+                object_id = getattr(obj, id_attr, None)
+                related = self._client.cache.get(object_type, object_id) if object_id else None
+                ticket[attr] = _to_json(related)
         return ticket
 
     @staticmethod
@@ -159,7 +389,7 @@ class ZendeskTickets():
         custom_fields = ['custom_fields', 'fields']
         fields_to_add = ['title', 'description', 'required', 'type']
         for cfield in custom_fields:
-            fields = ticket[cfield]
+            fields = ticket.get(cfield) or []
             for field in fields:
                 # We put an if here since we had cases where the id in field['id']
                 # was not in tfields.
@@ -167,3 +397,17 @@ class ZendeskTickets():
                     field['xdata'] = {
                         k: v for k, v in tfields[field['id']].items() if k in fields_to_add}
         return ticket
+
+
+def _to_json(value):
+    """Converts a Zenpy attribute value into JSON types, like the Zenpy objects to_dict"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, BaseObject):
+        return {(k[1:] if k.startswith('_') else k): _to_json(v)
+                for k, v in vars(value).items() if k not in ZENPY_ATTRIBUTES}
+    return str(value)
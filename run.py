@@ -1,12 +1,25 @@
 import sys
+import time
+import datetime
 import psycopg2
 import argparse
 import logging
 import logging.config
+from functools import partial
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from retrievers import RETRIEVERS
+from pipeline import Pipeline, DEF_QUEUE_SIZE
+from actions import TOKEN_CACHE, DEF_TOKEN_CACHE_SIZE, PHONE_PREFILTER_STATS
+from post_actions_pool import PostActionsPool, DEF_CHUNK_SIZE
+from change_index import ChangeIndex, CHANGE_INDEX_FILE_NAME
+from checkpoints import SourceCheckpoints, get_checkpoint, with_checkpoint
+from metrics import METRICS, STAGE_FETCH, STAGE_POST_ACTIONS, STAGE_WRITE
+from profiling import PROFILER, DEF_TOP_N
 
 from utils import read_yaml, get_start_time, prepare_post_actions_field_map, \
-    dump_date, handle_results_batch, DBconnection
+    dump_date, handle_results_batch, apply_post_actions_batch, dump_results_to_db, DBconnection, \
+    CopyLoader, WRITE_MODES, WRITE_MODE_ROW, WRITE_MODE_COPY, DATE_DUMP_FORMAT
 
 LOGGER_CONFIG_FILE_NAME = 'logger_config.yaml'
 logging.config.dictConfig(read_yaml(LOGGER_CONFIG_FILE_NAME))
@@ -14,74 +27,336 @@ LOG = logging.getLogger("root")
 EXIT_CODE_ON_ERR = 1
 
 
+def retrieve_source(retriever_config: dict, start_time: dict, max_items: int, cursor,
+                    write_mode: str = WRITE_MODE_ROW, show_progress: bool = True,
+                    pipeline_queue_size: int = 0, pool: PostActionsPool = None,
+                    change_index: ChangeIndex = None) -> dict:
+    """Pulls a single source and returns its summary. With a pipeline_queue_size, retrieving,
+    post actions and DB writes run as overlapping pipeline stages. With a pool, post actions of
+    large batches run in its worker processes. With a change_index, items which didn't change
+    since they were last written are skipped. Without a start_time, the source is pulled from
+    its last complete pull. The checkpoints of the batches are saved once they are written, so
+    an interrupted pull resumes from the last written batch."""
+    source_name = retriever_config['source_name']
+    summary = {'status': 'failed', 'success': 0, 'failures': 0, 'unchanged': 0, 'seconds': 0.0}
+    started = time.monotonic()
+    pull_time = datetime.datetime.now().strftime(DATE_DUMP_FORMAT)
+    # An explicit start time backfills, rather than resuming from the source's saved position
+    backfill = start_time is not None
+    start_time = start_time or get_start_time(source=source_name)
+
+    LOG.info(f"Start pulling {source_name} from {start_time}")
+    # Prepare post actions instructions map
+    post_action_map = prepare_post_actions_field_map(retriever_config['post_retrieval_actions'])
+    # Get the retriever class
+    retriever_class = RETRIEVERS.get(retriever_config['type'].lower())
+    # No retriever was found, proceed to the next source
+    if not retriever_class:
+        LOG.warning(f"Retriever {retriever_config['type']} not found")
+        summary['status'] = 'not found'
+        return summary
+
+    retriever = create_retriever(retriever_class, retriever_config, start_time, max_items,
+                                 backfill)
+    if retriever is None:
+        return summary
+
+    checkpoints = SourceCheckpoints(source_name)
+    loader = None
+    if write_mode == WRITE_MODE_COPY:
+        loader = CopyLoader(cursor, source_name, change_index=change_index,
+                            checkpoints=checkpoints)
+
+    batches = get_batches(retriever, source_name, post_action_map, pipeline_queue_size, pool)
+
+    # Start iterating over the retrieved batches, and handle them
+    try:
+        for results_batch in batches:
+            checkpoint = get_checkpoint(results_batch)
+            success, failures = write_batch(results_batch, source_name, post_action_map,
+                                            cursor, write_mode, loader, pool, change_index,
+                                            pipelined=bool(pipeline_queue_size))
+            checkpoints.add(checkpoint)
+            if not loader:
+                checkpoints.commit(failures)
+            summary['success'] += success
+            summary['failures'] += failures
+            log_progress(source_name, summary, show_progress)
+
+        success, failures = flush_loader(loader, source_name)
+        summary['success'] += success
+        summary['failures'] += failures
+
+        checkpoints.complete(pull_time)
+        if show_progress:
+            print()
+        summary['status'] = 'done'
+        if change_index:
+            summary['unchanged'] = change_index.unchanged(source_name)
+        LOG.info(
+            f"Done pulling {source_name}. Successfully pulled "
+            f"{summary['success']} items, {summary['failures']} items failed, "
+            f"{summary['unchanged']} items unchanged")
+    except Exception as e:
+        LOG.error(f"Got error while pulling items for {source_name}")
+        LOG.debug(e)
+        # Keep the items which were already retrieved before the error
+        success, failures = flush_loader(loader, source_name)
+        summary['success'] += success
+        summary['failures'] += failures
+        checkpoints.flush()
+
+    summary['seconds'] = time.monotonic() - started
+    METRICS.inc('rows_upserted_total', summary['success'], source=source_name)
+    METRICS.inc('rows_failed_total', summary['failures'], source=source_name)
+    METRICS.inc('rows_unchanged_total', summary['unchanged'], source=source_name)
+    return summary
+
+
+def create_retriever(retriever_class: type, retriever_config: dict, start_time: dict,
+                     max_items: int, backfill: bool = False) -> object:
+    """Initiates the retriever with the config params, returns None if it failed"""
+    try:
+        return retriever_class(source=retriever_config['source_name'],
+                               start_time=start_time, ignore_deleted=True,
+                               max_items=max_items, backfill=backfill,
+                               **retriever_config['params'])
+    except Exception as e:
+        LOG.error(f"Got error while initializing retriever {retriever_config['source_name']}")
+        LOG.debug(e)
+        return None
+
+
+def get_batches(retriever, source_name: str, post_action_map: dict,
+                pipeline_queue_size: int = 0, pool: PostActionsPool = None) -> Iterable:
+    """Returns the retrieved batches. With a pipeline_queue_size, they are retrieved and their
+    post actions applied by the pipeline stage threads."""
+    batches = iter_timed_batches(retriever, source_name)
+    if not pipeline_queue_size:
+        return batches
+    return Pipeline(batches,
+                    partial(apply_post_actions_stage, post_action_map=post_action_map,
+                            pool=pool, source_name=source_name),
+                    pipeline_queue_size, on_thread_exit=DBconnection().release,
+                    on_thread_start=partial(PROFILER.attach, source_name))
+
+
+def write_batch(results_batch: list, source_name: str, post_action_map: dict, cursor,
+                write_mode: str = WRITE_MODE_ROW, loader: CopyLoader = None,
+                pool: PostActionsPool = None, change_index: ChangeIndex = None,
+                pipelined: bool = False) -> tuple:
+    """Writes a retrieved batch to DB and returns the number of written and failed items.
+    Post actions are applied first, unless the pipeline already applied them."""
+    if not pipelined:
+        return handle_results_batch(results_batch, source_name, post_action_map, cursor,
+                                    write_mode, loader, pool, change_index)
+    with METRICS.timer('stage_seconds', source=source_name, stage=STAGE_WRITE):
+        return dump_results_to_db(results_batch, source_name, cursor, write_mode, loader,
+                                  change_index)
+
+
+def flush_loader(loader: CopyLoader, source_name: str) -> tuple:
+    """Writes the rows buffered by the source's bulk loader, if it has one, and returns the
+    number of written and failed items"""
+    if not loader:
+        return 0, 0
+    with METRICS.timer('stage_seconds', source=source_name, stage=STAGE_WRITE):
+        return loader.flush()
+
+
+def log_progress(source_name: str, summary: dict, show_progress: bool = True):
+    """Shows the source's items count so far, or logs it when sources run concurrently"""
+    if show_progress:
+        print(f"total_success={summary['success']} "
+              f"total_failures={summary['failures']}", end='\r')
+    else:
+        LOG.debug(f"{source_name}: total_success={summary['success']} "
+                  f"total_failures={summary['failures']}")
+
+
+def iter_timed_batches(retriever, source_name: str):
+    """Yields the retrieved batches, timing the fetch stage in the run metrics"""
+    batches = iter(retriever)
+    while True:
+        started = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            # Work done after the last batch, like syncing deleted items
+            METRICS.observe('stage_seconds', time.perf_counter() - started,
+                            source=source_name, stage=STAGE_FETCH)
+            return
+        METRICS.observe('stage_seconds', time.perf_counter() - started,
+                        source=source_name, stage=STAGE_FETCH)
+        METRICS.inc('items_retrieved_total', len(batch), source=source_name)
+        yield batch
+
+
+def apply_post_actions_stage(results_batch: list, post_action_map: dict,
+                             pool: PostActionsPool = None, source_name: str = None) -> list:
+    """Pipeline transform stage, applies the post actions and keeps the batch checkpoint"""
+    with METRICS.timer('stage_seconds', source=source_name, stage=STAGE_POST_ACTIONS):
+        results_batch_altered = apply_post_actions_batch(results_batch, post_action_map, pool)
+    return with_checkpoint(results_batch_altered, get_checkpoint(results_batch))
+
+
+def retrieve_source_in_thread(retriever_config: dict, start_time: dict, max_items: int,
+                              write_mode: str = WRITE_MODE_ROW,
+                              pipeline_queue_size: int = 0, pool: PostActionsPool = None,
+                              change_index: ChangeIndex = None) -> dict:
+    """Pulls a single source with the thread's own pooled DB connection"""
+    try:
+        cursor = DBconnection().get_cursor()
+        with PROFILER.profile_source(retriever_config['source_name']):
+            return retrieve_source(retriever_config, start_time, max_items, cursor, write_mode,
+                                   show_progress=False, pipeline_queue_size=pipeline_queue_size,
+                                   pool=pool, change_index=change_index)
+    finally:
+        DBconnection().release()
+
+
 # main retrieving loop
-def retrieve(config: dict, start_time: dict, max_items: int, cursor):
+def retrieve(config: dict, start_time: dict, max_items: int, cursor,
+             write_mode: str = WRITE_MODE_ROW, parallel_sources: int = 1,
+             pipeline_queue_size: int = 0, pool: PostActionsPool = None,
+             change_index: ChangeIndex = None):
 
     LOG.info('Start retriever task')
-    # Dumps date of last sussesfull pull
-    dump_date()
+    pull_time = datetime.datetime.now()
 
+    summaries = {}
+    retriever_configs = []
     for retriever_config in config['Retrievers']:
-        total_success = total_failures = 0
-
         # If retriever is disabled in config, proceed to the next retriever
         if not retriever_config.get('enabled', False):
             LOG.info(f"Skipping {retriever_config['source_name']} as it is disabled in config")
             continue
+        retriever_configs.append(retriever_config)
 
-        LOG.info(f"Start pulling {retriever_config['source_name']}")
-        # Prepare post actions instructions map
-        post_action_map = prepare_post_actions_field_map(retriever_config['post_retrieval_actions'])
-        # Get the retriever class
-        retriever_class = RETRIEVERS.get(retriever_config['type'].lower())
-        # No retriever was found, proceed to the next source
-        if not retriever_class:
-            LOG.warning(f"Retriever {retriever_config['type']} not found")
-            continue
+    if parallel_sources > 1:
+        # Each source runs in its own thread, with its own connection from the pool
+        with ThreadPoolExecutor(max_workers=parallel_sources,
+                                thread_name_prefix='source') as sources_pool:
+            futures = {
+                retriever_config['source_name']: sources_pool.submit(
+                    retrieve_source_in_thread, retriever_config, start_time, max_items,
+                    write_mode, pipeline_queue_size, pool, change_index)
+                for retriever_config in retriever_configs}
 
-        # Initiate the retriever with config params
-        try:
-            retriever = retriever_class(source=retriever_config['source_name'],
-                                        start_time=start_time, ignore_deleted=True,
-                                        max_items=max_items,
-                                        **retriever_config['params'])
-        except Exception as e:
-            LOG.error(f"Got error while initializing retriever {retriever_config['source_name']}")
-            LOG.debug(e)
-            continue
+            for source_name, future in futures.items():
+                try:
+                    summaries[source_name] = future.result()
+                except Exception as e:
+                    LOG.error(f"Got error while pulling items for {source_name}")
+                    LOG.debug(e)
+    else:
+        for retriever_config in retriever_configs:
+            with PROFILER.profile_source(retriever_config['source_name']):
+                summaries[retriever_config['source_name']] = retrieve_source(
+                    retriever_config, start_time, max_items, cursor, write_mode,
+                    pipeline_queue_size=pipeline_queue_size, pool=pool,
+                    change_index=change_index)
 
-        # Start iterating over the retrieved batches, and handle them
-        try:
-            for results_batch in retriever:
-                success, failures = handle_results_batch(results_batch,
-                                                         retriever_config['source_name'],
-                                                         post_action_map, cursor)
-                total_success += success
-                total_failures += failures
-                print(f'{total_success=} {total_failures=}', end='\r')
+    for source_name, summary in summaries.items():
+        LOG.info(f"{source_name}: {summary['status']}, {summary['success']} items pulled, "
+                 f"{summary['failures']} items failed, {summary['unchanged']} items unchanged "
+                 f"in {summary['seconds']:.1f} seconds")
+        log_source_metrics(source_name)
 
-            print()
-            LOG.info(
-                f"Done pulling {retriever_config['source_name']}. Successfully pulled "
-                f"{total_success} items, {total_failures} items failed")
-        except Exception as e:
-            LOG.error(f"Got error while pulling items for {retriever_config['source_name']}")
-            LOG.debug(e)
+    # Dumps date of last sussesfull pull, once every source was pulled without failed items
+    if len(summaries) == len(retriever_configs) and \
+            all(summary['status'] == 'done' and not summary['failures']
+                for summary in summaries.values()):
+        dump_date(pull_time)
+
+    cache_stats = TOKEN_CACHE.stats()
+    LOG.info(f"Token cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+             f"({cache_stats['hit_rate']:.1%} hit rate), {cache_stats['size']} of "
+             f"{cache_stats['max_size']} entries used")
+    log_prefilter_stats()
 
     LOG.info('Retriever task completed!')
 
 
+def log_source_metrics(source_name: str):
+    """Logs where the source's time went"""
+    stages = {stage: METRICS.get_seconds('stage_seconds', source=source_name, stage=stage)
+              for stage in (STAGE_FETCH, STAGE_POST_ACTIONS, STAGE_WRITE)}
+    LOG.info(f"{source_name}: {stages[STAGE_FETCH]:.1f} seconds fetching, "
+             f"{stages[STAGE_POST_ACTIONS]:.1f} seconds in post actions, "
+             f"{stages[STAGE_WRITE]:.1f} seconds writing, "
+             f"{METRICS.get('http_requests_total', source=source_name):.0f} HTTP requests "
+             f"({METRICS.get('http_response_bytes_total', source=source_name) / 2 ** 20:.1f} MB), "
+             f"{METRICS.get('http_retries_total', source=source_name):.0f} retries, "
+             f"{METRICS.get('throttle_sleep_seconds_total', source=source_name):.1f} seconds "
+             f"throttled")
+
+
+def log_prefilter_stats():
+    """Logs how much of the content the phone number pre-filter kept from the matcher"""
+    prefilter_stats = PHONE_PREFILTER_STATS.stats()
+    for field, stats in sorted(prefilter_stats.items(), key=lambda x: -x[1]['chars']):
+        if not stats['strings']:
+            continue
+        skipped_chars = 1 - stats['scanned_chars'] / stats['chars'] if stats['chars'] else 0
+        message = f"{stats['skipped']} of {stats['strings']} strings " \
+            f"({stats['skipped'] / stats['strings']:.1%}) and {skipped_chars:.1%} of the " \
+            f"characters skipped"
+        if field is None:
+            LOG.info(f"Phone number pre-filter: {message}")
+        else:
+            LOG.debug(f"Phone number pre-filter, field {field}: {message}")
+
+
 def create_argparser() -> argparse.ArgumentParser:
     """Parses and returns command line arguments"""
     HELP_CONFIG = 'Sources configuration path'
-    HELP_STARTTIME = 'Specify from what time to pull data'
+    HELP_STARTTIME = 'Specify from what time to pull data (default: each source from its last '\
+        'complete pull)'
     HELP_MAXITEMS = 'Number of max items to pull (used for testing)'
+    HELP_PARALLEL = 'Number of sources to pull concurrently (default: 1)'
+    HELP_PIPELINE = 'Overlap retrieving, post actions and DB writes of each source'
+    HELP_QUEUESIZE = f'Number of batches each pipeline stage may hold (default: {DEF_QUEUE_SIZE})'
+    HELP_WRITEMODE = 'How to write items to DB: one upsert per item (row), per batch (batch) or '\
+        'bulk COPY through a staging table (copy). Overrides write_mode in the Target config'
+    HELP_WORKERS = 'Number of worker processes applying post actions on large batches, 0 applies '\
+        'them in process (default: 0)'
+    HELP_CHUNKSIZE = 'Number of items sent to a post actions worker at once '\
+        f'(default: {DEF_CHUNK_SIZE})'
+    HELP_SKIPUNCHANGED = 'Skip writing items whose content did not change since they were last '\
+        f'written, tracked by content hashes in {CHANGE_INDEX_FILE_NAME}'
+    HELP_METRICSREPORT = 'Path of a JSON report of the run metrics to write'
+    HELP_METRICSTEXTFILE = 'Path of a Prometheus textfile of the run metrics to write, for the '\
+        'node exporter textfile collector'
+    HELP_PROFILE = 'Profile each source on its own by sampling its threads, writing their '\
+        'sampled stacks (for flamegraph tools) to the given directory and logging their hotspots'
+    HELP_PROFILEMEMORY = 'Also trace memory allocations while profiling, dumping a tracemalloc '\
+        'snapshot of each source and logging where it allocated the most (slower)'
+    HELP_PROFILETOP = f'Number of hotspots logged per profiled source (default: {DEF_TOP_N})'
+    HELP_TOKENCACHE = 'Number of anonymized tokens to keep in memory, 0 disables the cache '\
+        f'(default: {DEF_TOKEN_CACHE_SIZE})'
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument('config', type=str, help=HELP_CONFIG)
     parser.add_argument('-s', '--starttime', type=str, help=HELP_STARTTIME)
     parser.add_argument('--max-items', type=int, help=HELP_MAXITEMS)
+    parser.add_argument('--write-mode', choices=WRITE_MODES, help=HELP_WRITEMODE)
+    parser.add_argument('--parallel-sources', type=int, default=1, help=HELP_PARALLEL)
+    parser.add_argument('--pipeline', action='store_true', help=HELP_PIPELINE)
+    parser.add_argument('--pipeline-queue-size', type=int, default=DEF_QUEUE_SIZE,
+                        help=HELP_QUEUESIZE)
+    parser.add_argument('--post-action-workers', type=int, default=0, help=HELP_WORKERS)
+    parser.add_argument('--post-action-chunk-size', type=int, default=DEF_CHUNK_SIZE,
+                        help=HELP_CHUNKSIZE)
+    parser.add_argument('--skip-unchanged', action='store_true', help=HELP_SKIPUNCHANGED)
+    parser.add_argument('--token-cache-size', type=int, default=DEF_TOKEN_CACHE_SIZE,
+                        help=HELP_TOKENCACHE)
+    parser.add_argument('--metrics-report', type=str, help=HELP_METRICSREPORT)
+    parser.add_argument('--metrics-textfile', type=str, help=HELP_METRICSTEXTFILE)
+    parser.add_argument('--profile', type=str, metavar='DIR', help=HELP_PROFILE)
+    parser.add_argument('--profile-memory', action='store_true', help=HELP_PROFILEMEMORY)
+    parser.add_argument('--profile-top', type=int, default=DEF_TOP_N, help=HELP_PROFILETOP)
 
     return parser
 
@@ -96,14 +371,49 @@ if __name__ == '__main__':
         LOG.error(f'Could not open configuration file {options.config}')
         sys.exit(EXIT_CODE_ON_ERR)
 
-    start_time = get_start_time(options.starttime)
+    # Without a start time, each source starts from its own last complete pull
+    start_time = get_start_time(options.starttime) if options.starttime else None
+
+    # write_mode is not a connection parameter, so it is taken out of the Target block
+    target = dict(config['Target'])
+    config_write_mode = target.pop('write_mode', None)
+    write_mode = options.write_mode or config_write_mode or WRITE_MODE_ROW
+    if write_mode not in WRITE_MODES:
+        LOG.error(f'Unknown write mode {write_mode}, expected one of {WRITE_MODES}')
+        sys.exit(EXIT_CODE_ON_ERR)
 
-    cursor = DBconnection(config['Target']).get_cursor()
+    parallel_sources = max(options.parallel_sources, 1)
+    # Every concurrent source may also use a connection from its retriever thread
+    cursor = DBconnection(target, max_connections=2 * parallel_sources + 1).get_cursor()
     max_items = options.max_items
+    pipeline_queue_size = max(options.pipeline_queue_size, 1) if options.pipeline else 0
+    TOKEN_CACHE.resize(options.token_cache_size)
+    pool = None
+    if options.post_action_workers > 0:
+        pool = PostActionsPool(options.post_action_workers, options.post_action_chunk_size)
+    change_index = None
+    if options.skip_unchanged:
+        change_index = ChangeIndex(f"{target.get('host')}/{target.get('dbname')}")
+    if options.profile:
+        PROFILER.start(options.profile, top=options.profile_top,
+                       trace_memory=options.profile_memory)
+    elif options.profile_memory:
+        LOG.warning('--profile-memory is ignored without --profile')
 
     try:
-        retrieve(config, start_time, max_items, cursor)
+        retrieve(config, start_time, max_items, cursor, write_mode, parallel_sources,
+                 pipeline_queue_size, pool, change_index)
     except Exception as e:
         LOG.error('Pull failed!')
         LOG.debug(e)
         sys.exit(EXIT_CODE_ON_ERR)
+    finally:
+        if pool:
+            pool.close()
+        if change_index:
+            change_index.close()
+        PROFILER.stop()
+        if options.metrics_report:
+            METRICS.write_report(options.metrics_report)
+        if options.metrics_textfile:
+            METRICS.write_textfile(options.metrics_textfile)
@@ -1,15 +1,20 @@
+import os
 import sys
 import yaml
 import json
-import pytz
 import logging
 import dateutil
 import datetime
+import threading
+import time
 from pathlib import Path
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.pool import PoolError
+from psycopg2.extensions import TransactionRollbackError
+from psycopg2.extras import Json, execute_values
 from collections import defaultdict
-from actions import FUNCTIONS
+from actions import FUNCTIONS, compile_action
+from metrics import METRICS, STAGE_POST_ACTIONS, STAGE_WRITE
 from collections.abc import Iterable
 
 LOG = logging.getLogger("root")
@@ -17,6 +22,56 @@ DATE_DUMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 PULL_TIME_DELTA_MINS = 15
 PULL_TIME_DELTA_DAYS = 1
 EXIT_CODE_ON_ERR = 1
+# Per source pull state (like export cursors), kept between runs
+STATE_FILE_NAME = 'pull_state.json'
+STATE_LOCK = threading.Lock()
+# State key of the start time of the last complete pull of a source
+LAST_PULL_KEY = 'last_pull'
+
+# DB write modes: one statement and commit per item, one multi-row statement per batch, or
+# COPY into a staging table that is merged into rawitem every COPY_FLUSH_SIZE items
+WRITE_MODE_ROW = 'row'
+WRITE_MODE_BATCH = 'batch'
+WRITE_MODE_COPY = 'copy'
+WRITE_MODES = (WRITE_MODE_ROW, WRITE_MODE_BATCH, WRITE_MODE_COPY)
+COPY_FLUSH_SIZE = 5000
+
+# Connection pool: idle seconds before a connection is pinged, retries of transient errors,
+# first retry delay (doubled on each retry) and seconds to wait for a free connection
+DB_HEALTHCHECK_INTERVAL = 60
+DB_RETRIES = 3
+DB_RETRY_DELAY = 1
+DB_CHECKOUT_TIMEOUT = 300
+TRANSIENT_DB_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+RAWITEM_COLUMNS = "source, item_id, title, created_at, json, dataupdate_id, deleted"
+ON_CONFLICT_SQL = "ON CONFLICT (source, item_id) DO UPDATE SET (created_at, title, json) = "\
+                  "(EXCLUDED.created_at, EXCLUDED.title, EXCLUDED.json)"
+UPSERT_SQL = f"INSERT INTO rawitem ({RAWITEM_COLUMNS}) VALUES {{values}} {ON_CONFLICT_SQL}"
+ROW_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s)"
+
+STAGING_TABLE_SQL = "CREATE TEMP TABLE IF NOT EXISTS rawitem_staging ON COMMIT DELETE ROWS AS "\
+                    f"SELECT 0::bigint AS seq, {RAWITEM_COLUMNS} FROM rawitem WITH NO DATA"
+STAGING_COPY_SQL = f"COPY rawitem_staging (seq, {RAWITEM_COLUMNS}) FROM STDIN"
+# Keeps the last staged version of every item, as a single statement can't update a row twice
+STAGING_MERGE_SQL = f"INSERT INTO rawitem ({RAWITEM_COLUMNS}) "\
+                    f"SELECT DISTINCT ON (source, item_id) {RAWITEM_COLUMNS} "\
+                    f"FROM rawitem_staging ORDER BY source, item_id, seq DESC {ON_CONFLICT_SQL}"
+
+# Deleted states sync through a temporary table of item ids and their deleted state
+DELETED_TABLE_SQL = "CREATE TEMP TABLE deleted_items ON COMMIT DROP AS "\
+                    "SELECT item_id, deleted FROM rawitem WITH NO DATA"
+DELETED_COPY_SQL = "COPY deleted_items (item_id, deleted) FROM STDIN"
+# Every item of the source which is missing from deleted_items is deleted
+DELETED_SYNC_SQL = "UPDATE rawitem r SET deleted = t.deleted FROM ("\
+                   "SELECT i.item_id, COALESCE(d.deleted, true) AS deleted FROM rawitem i "\
+                   "LEFT JOIN deleted_items d ON d.item_id = i.item_id "\
+                   "WHERE i.source = %(source)s) t "\
+                   "WHERE r.source = %(source)s AND r.item_id = t.item_id "\
+                   "AND r.deleted IS DISTINCT FROM t.deleted RETURNING r.deleted"
+DELETED_UPDATE_SQL = "UPDATE rawitem r SET deleted = d.deleted FROM deleted_items d "\
+                     "WHERE r.source = %(source)s AND r.item_id = d.item_id "\
+                     "AND r.deleted IS DISTINCT FROM d.deleted RETURNING r.deleted"
 
 
 def read_yaml(path: Path) -> dict:
@@ -39,13 +94,15 @@ def read_yaml(path: Path) -> dict:
         return None
 
 
-def get_start_time(start_time: str = None) -> datetime:
+def get_start_time(start_time: str = None, source: str = None) -> datetime:
     """Get Start Time
     If a data update record exists returns the created_at time after subtraction of the default
     overlap time (in minutes) from it. If no data update record exists, returns default start time.
+    The source's own last complete pull is used over the pull_history.txt record.
 
     Arguments:
         start_time (str): From when to pull data (default: None).
+        source (str): Source name (default: None).
 
     Returns:
         datetime: Start time for pull operation.
@@ -54,6 +111,10 @@ def get_start_time(start_time: str = None) -> datetime:
     if start_time:
         return dateutil.parser.parse(start_time)
 
+    last_pull = load_state(source).get(LAST_PULL_KEY) if source else None
+    if last_pull:
+        return dateutil.parser.parse(last_pull) - datetime.timedelta(minutes=PULL_TIME_DELTA_MINS)
+
     try:
         with open('pull_history.txt', 'r') as file:
             date_str = file.readline()
@@ -65,13 +126,16 @@ def get_start_time(start_time: str = None) -> datetime:
     return datetime.datetime.now() - datetime.timedelta(days=PULL_TIME_DELTA_DAYS)
 
 
-def dump_date():
+def dump_date(time: datetime = None):
     """Dump date
     dumps the date of the latest successfull pull to file
+
+    Arguments:
+        time (datetime): When the pull started (default: now).
     """
     try:
         with open('pull_history.txt', 'w') as file:
-            time = datetime.datetime.now()
+            time = time or datetime.datetime.now()
             file.write(time.strftime(DATE_DUMP_FORMAT))
         return True
     except Exception as e:
@@ -80,6 +144,60 @@ def dump_date():
         return False
 
 
+def load_state(source: str) -> dict:
+    """Load state
+    Returns the pull state saved for the source by previous runs
+
+    Args:
+        source (str): Source name
+
+    Returns:
+        dict: The source state, empty if no state was saved
+    """
+    with STATE_LOCK:
+        try:
+            with open(STATE_FILE_NAME, 'r', encoding='utf-8') as file:
+                return json.load(file).get(source, {})
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            LOG.error(f'Got error while reading {STATE_FILE_NAME} file!')
+            LOG.debug(e)
+            return {}
+
+
+def save_state(source: str, state: dict) -> bool:
+    """Save state
+    Updates the pull state of the source. The state file is replaced atomically, so a crash
+    never leaves a partially written file behind.
+
+    Args:
+        source (str): Source name
+        state (dict): State keys to update
+
+    Returns:
+        bool: True if the state was saved
+    """
+    with STATE_LOCK:
+        try:
+            try:
+                with open(STATE_FILE_NAME, 'r', encoding='utf-8') as file:
+                    states = json.load(file)
+            except FileNotFoundError:
+                states = {}
+
+            states.setdefault(source, {}).update(state)
+            tmp_file_name = f'{STATE_FILE_NAME}.tmp'
+            with open(tmp_file_name, 'w', encoding='utf-8') as file:
+                json.dump(states, file, indent=2, default=str)
+            os.replace(tmp_file_name, STATE_FILE_NAME)
+            return True
+        except Exception as e:
+            LOG.error(f'Got error while writing to {STATE_FILE_NAME} file!')
+            LOG.debug(e)
+            return False
+
+
 def create_cursor(conn: psycopg2.connect, name: str = "default", itersize: int = 1000):
     """Create cursor
     creates named cursor and sets the itersize
@@ -100,16 +218,21 @@ def create_cursor(conn: psycopg2.connect, name: str = "default", itersize: int =
 def prepare_post_actions_field_map(config: list) -> dict:
     """Preparepost post actions field map
     Constructs a dictionary with fields as keys. The values are lists of functions to be applied
-    to the field
+    to the field. The map also holds the dispatch plan used by apply_post_actions: the actions
+    compiled for their blacklisted patterns, the fields each action skips, and a cache of the
+    actions to apply per field key.
 
     Args:
         config (list): configuration dict
 
     Returns:
-        dict: the post actions field -> key:str - value[callable1, ...]
+        dict: the post actions field -> key:str - value[callable1, ...], the actions config and
+            the dispatch plan
     """
     field_to_action_map = defaultdict(list)
     actions_config = {}
+    compiled_actions = {}
+    blacklisted_fields = {}
 
     for action in config:
         function_name = action.get('function')
@@ -119,13 +242,45 @@ def prepare_post_actions_field_map(config: list) -> dict:
             continue
 
         actions_config[function_name] = action
+        # Bind the action to its blacklisted patterns once, instead of once per field value
+        compiled_actions[function_name] = compile_action(
+            function_name, action.get('blacklisted_patterns', []) or [])
+        blacklisted_fields[function_name] = frozenset(action.get('blacklisted_fields', []) or [])
         if action.get('apply_to_all'):
             field_to_action_map['_all'].append(function_name)
         else:
             for field in action.get('fields', []) or []:
                 field_to_action_map[field].append(function_name)
 
-    return {'field_to_action_map': field_to_action_map, 'actions_config': actions_config}
+    return {'field_to_action_map': field_to_action_map, 'actions_config': actions_config,
+            'compiled_actions': compiled_actions, 'blacklisted_fields': blacklisted_fields,
+            'has_actions': bool(compiled_actions), 'field_actions': {}, 'config': config,
+            'config_key': json.dumps(config, sort_keys=True, default=str)}
+
+
+def get_field_actions(key: str, post_action_map: dict) -> tuple:
+    """Get field actions
+    Returns the compiled actions to apply on the values of a field, in order. They are resolved
+    once per field key and cached in the post action map.
+
+    Args:
+        key (str): key of the field
+        post_action_map (dict): field to function mapper
+
+    Returns:
+        tuple: compiled actions, (value, key) -> altered value
+    """
+    field_actions = post_action_map['field_actions']
+    actions = field_actions.get(key)
+    if actions is None:
+        field_to_action_map = post_action_map['field_to_action_map']
+        actions = tuple(
+            post_action_map['compiled_actions'][action]
+            for action in field_to_action_map.get('_all', []) + field_to_action_map.get(key, [])
+            # If field is blacklisted, skip the action
+            if key not in post_action_map['blacklisted_fields'][action])
+        field_actions[key] = actions
+    return actions
 
 
 def apply_actions_on_field(key: str, value: str, post_action_map: dict) -> str:
@@ -140,28 +295,17 @@ def apply_actions_on_field(key: str, value: str, post_action_map: dict) -> str:
     Returns:
         str: altered value
     """
-    for action in post_action_map['field_to_action_map']['_all'] + \
-            post_action_map['field_to_action_map'].get(key, []) or []:
-
-        if action not in FUNCTIONS:
-            # no such action in function map
-            continue
-
-        # If field is blacklisted, continue to the next action
-        if key in post_action_map['actions_config'].get('blacklisted_fields', []) or []:
-            continue
-
-        value = FUNCTIONS[action](
-            value,
-            post_action_map['actions_config'][action].get('blacklisted_patterns', []) or []
-        )
+    for action in get_field_actions(key, post_action_map):
+        value = action(value, key)
 
     return value
 
 
 def apply_post_actions(data: object, key: str = None, post_action_map: dict = None) -> dict:
     """ Apply actions on fields
-    Simple recursion which traverses a dictionary and applies functions on the string values
+    Simple recursion which traverses a dictionary and applies functions on the string values.
+    Values no action can alter (numbers, booleans, nulls and strings of fields without actions)
+    are not visited.
 
     Args:
         data (object): the root dictionary to traverse
@@ -171,25 +315,239 @@ def apply_post_actions(data: object, key: str = None, post_action_map: dict = No
     Returns:
         dict: the altered dictionary
     """
+    if not post_action_map['has_actions']:
+        return data
+
+    return _apply_post_actions(data, key, post_action_map)
+
 
+def _apply_post_actions(data: object, key: str, post_action_map: dict) -> object:
+    """Traversal of apply_post_actions"""
     if isinstance(data, str):
-        return apply_actions_on_field(key, data, post_action_map)
+        for action in get_field_actions(key, post_action_map):
+            data = action(data, key)
+        return data
 
     elif isinstance(data, list):
-        new_data = []
-        for item in data:
-            new_data.append(apply_post_actions(item, key, post_action_map))
-        return new_data
+        # List items inherit the key of the list, so without actions for it only nested
+        # containers have to be visited
+        if get_field_actions(key, post_action_map):
+            return [_apply_post_actions(item, key, post_action_map) for item in data]
+        return [_apply_post_actions(item, key, post_action_map)
+                if isinstance(item, (dict, list)) else item for item in data]
 
     elif isinstance(data, dict):
         for k, v in data.items():
-            data[k] = apply_post_actions(v, k, post_action_map)
+            if isinstance(v, (str, list, dict)):
+                data[k] = _apply_post_actions(v, k, post_action_map)
         return data
 
     return data
 
 
-def dump_results_to_db(results: list, source_name: str, cursor):
+def item_to_row(item: dict, source_name: str) -> tuple:
+    """Item to row
+    Builds the rawitem row values for a single item
+
+    Args:
+        item (dict): Retrieved item
+        source_name (str): Source name
+
+    Returns:
+        tuple: values matching ROW_TEMPLATE
+    """
+    iid = item.get('id')
+    title = item.get('title') or item.get('subject') or ''
+    created_at = datetime.datetime.utcnow()
+    deleted = item.get('deleted', False) or False
+    return (source_name, iid, title, created_at, Json(item), 1, deleted)
+
+
+def rollback(cursor):
+    """Rollback
+    Rolls back the current transaction so the cursor can be used again after an error
+    """
+    try:
+        cursor.execute('rollback')
+    except Exception as e:
+        LOG.debug(e)
+
+
+def upsert_rows(rows: list, cursor) -> tuple:
+    """Upsert rows
+    Upserts all rows with a single multi-row statement inside one transaction. If the
+    statement fails, the rows are bisected and retried, so each bad row ends up as exactly
+    one failure.
+
+    A single statement can't update a row twice, so only the last row of every item is
+    upserted. Like with the bulk loader merge, the earlier rows of an item share the outcome
+    of its last row. Rows without an item id are not merged, so each of them fails on its own.
+
+    Args:
+        rows (list): rawitem rows, as built by item_to_row
+        cursor (psycopg2.Cursor): DB connection cursor
+
+    Returns:
+        tuple: number of upserted rows, number of failed rows
+    """
+    # (source, item_id) -> last row, which keeps the position of the item's first row
+    last_rows = {}
+    superseded = defaultdict(int)
+    for index, row in enumerate(rows):
+        key = row[:2] if row[1] is not None else index
+        if key in last_rows:
+            superseded[key] += 1
+        last_rows[key] = row
+
+    failed_keys = _upsert_rows(list(last_rows.items()), cursor)
+    failures = sum(1 + superseded[key] for key in failed_keys)
+    return len(rows) - failures, failures
+
+
+def _upsert_rows(keyed_rows: list, cursor) -> list:
+    """Upserts (key, row) pairs of distinct items, bisecting them on errors. Returns the keys
+    of the rows which failed."""
+    if not keyed_rows:
+        return []
+
+    try:
+        execute_values(cursor, UPSERT_SQL.format(values='%s'), [row for _, row in keyed_rows],
+                       template=ROW_TEMPLATE, page_size=len(keyed_rows))
+        cursor.execute('commit')
+        return []
+    except Exception as e:
+        rollback(cursor)
+        if len(keyed_rows) == 1:
+            LOG.error('Got error while inserting a line to DB')
+            LOG.debug(e)
+            return [keyed_rows[0][0]]
+
+    middle = len(keyed_rows) // 2
+    return _upsert_rows(keyed_rows[:middle], cursor) + _upsert_rows(keyed_rows[middle:], cursor)
+
+
+def copy_value(value) -> str:
+    """Copy value
+    Serializes a single value in the COPY text format
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, Json):
+        value = json.dumps(value.adapted)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n') \
+        .replace('\r', '\\r')
+
+
+class CopyStream():
+    '''File like object which serializes rows for COPY FROM STDIN as they are read'''
+
+    def __init__(self, rows: Iterable) -> None:
+        self._rows = iter(rows)
+        self._buffer = ''
+
+    def read(self, size: int = -1) -> str:
+        """Read
+        Returns up to size characters of serialized rows (all of them if size is negative)
+        """
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._buffer += '\t'.join(copy_value(v) for v in row) + '\n'
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class CopyLoader():
+    '''Bulk loader
+    Buffers items and streams them with COPY into a temporary staging table, which is merged
+    into rawitem with a single INSERT ... SELECT ... ON CONFLICT per flush. The checkpoints of
+    the source are committed along with each flush.
+    '''
+
+    def __init__(self, cursor, source_name: str, flush_size: int = COPY_FLUSH_SIZE,
+                 change_index: object = None, checkpoints: object = None) -> None:
+        self._cursor = cursor
+        self._source_name = source_name
+        self._flush_size = flush_size
+        self._change_index = change_index
+        self._checkpoints = checkpoints
+        self._rows: list = []
+        self._hashes: list = []
+
+    def add(self, results: list, hashes: list = None) -> tuple:
+        """Add
+        Buffers the results and flushes them when the buffer is full.
+
+        Args:
+            results (list): List of results
+            hashes (list, optional): The results content hashes, committed to the change index
+                once they are flushed.
+
+        Returns:
+            tuple: number of written items, number of failed items. Buffered items are
+                counted when they are flushed.
+        """
+        success = failures = 0
+        for index, item in enumerate(results):
+            try:
+                self._rows.append(item_to_row(item, self._source_name))
+                if hashes:
+                    self._hashes.append(hashes[index])
+            except Exception as e:
+                LOG.error('Got error while preparing a line for DB')
+                LOG.debug(e)
+                failures += 1
+
+        if len(self._rows) >= self._flush_size:
+            success, flush_failures = self.flush()
+            failures += flush_failures
+
+        return success, failures
+
+    def flush(self) -> tuple:
+        """Flush
+        Copies the buffered rows to the staging table and merges them into rawitem in one
+        transaction. If that fails, falls back to batched upserts of the buffered rows.
+
+        Returns:
+            tuple: number of written items, number of failed items
+        """
+        rows, self._rows = self._rows, []
+        hashes, self._hashes = self._hashes, []
+        if not rows:
+            # Every item added so far was written
+            if self._checkpoints:
+                self._checkpoints.commit()
+            return 0, 0
+
+        try:
+            self._cursor.execute(STAGING_TABLE_SQL)
+            self._cursor.copy_expert(STAGING_COPY_SQL,
+                                     CopyStream((seq,) + row for seq, row in enumerate(rows)))
+            self._cursor.execute(STAGING_MERGE_SQL)
+            self._cursor.execute('commit')
+            success, failures = len(rows), 0
+        except Exception as e:
+            LOG.warning('Bulk load of %s items failed, falling back to batched upserts', len(rows))
+            LOG.debug(e)
+            rollback(self._cursor)
+            success, failures = upsert_rows(rows, self._cursor)
+
+        # The failed rows are unknown, so hashes are only kept when all the rows were written
+        if self._change_index and not failures:
+            self._change_index.commit(self._source_name, hashes)
+        if self._checkpoints:
+            self._checkpoints.commit(failures)
+        return success, failures
+
+
+def dump_results_to_db(results: list, source_name: str, cursor,
+                       write_mode: str = WRITE_MODE_ROW, loader: CopyLoader = None,
+                       change_index: object = None):
     """Dump results to DB
     Dumps results batch to DB
 
@@ -197,88 +555,211 @@ def dump_results_to_db(results: list, source_name: str, cursor):
         results (list): List of results
         source_name (str): Source name
         cursor (psycopg2.Cursor): DB connection cursor
+        write_mode (str, optional): One of WRITE_MODES. Defaults to WRITE_MODE_ROW.
+        loader (CopyLoader, optional): The source's bulk loader, used by WRITE_MODE_COPY.
+        change_index (ChangeIndex, optional): Skips the items which didn't change since they
+            were last written. Defaults to None.
+
+    Returns:
+        tuple: number of successfully written items, number of failed items. Skipped items
+            are not counted.
     """
-    success = failures = 0
+    hashes = None
+    if change_index:
+        results, hashes = change_index.filter(source_name, results)
+
+    if write_mode == WRITE_MODE_COPY:
+        return loader.add(results, hashes)
+    if write_mode == WRITE_MODE_BATCH:
+        return dump_results_batch(results, source_name, cursor, hashes, change_index)
+    return dump_results_rows(results, source_name, cursor, hashes, change_index)
+
 
-    def get_create_at(item):
-        """sets the created_at field with UTC timezone"""
-        created_at = dateutil.parser.parse(item['created_at'])
-        if not created_at.tzinfo:
-            created_at = pytz.utc.localize(created_at)
-        return created_at
+def dump_results_batch(results: list, source_name: str, cursor, hashes: list = None,
+                       change_index: object = None) -> tuple:
+    """Dump results batch
+    Dumps the results with a single multi-row upsert (WRITE_MODE_BATCH)
+
+    Args:
+        results (list): List of results
+        source_name (str): Source name
+        cursor (psycopg2.Cursor): DB connection cursor
+        hashes (list, optional): The results content hashes. Defaults to None.
+        change_index (ChangeIndex, optional): Commits the hashes once the results were
+            written. Defaults to None.
 
+    Returns:
+        tuple: number of successfully written items, number of failed items
+    """
+    rows = []
+    failures = 0
     for item in results:
+        try:
+            rows.append(item_to_row(item, source_name))
+        except Exception as e:
+            LOG.error('Got error while preparing a line for DB')
+            LOG.debug(e)
+            failures += 1
+    success, batch_failures = upsert_rows(rows, cursor)
+    failures += batch_failures
+    # The failed rows are unknown, so hashes are only kept when all the rows were written
+    if change_index and not failures:
+        change_index.commit(source_name, hashes)
+    return success, failures
+
+
+def dump_results_rows(results: list, source_name: str, cursor, hashes: list = None,
+                      change_index: object = None) -> tuple:
+    """Dump results rows
+    Dumps the results with one upsert per item (WRITE_MODE_ROW)
 
-        iid = item.get('id')
-        title = item.get('title') or item.get('subject') or ''
-        created_at = datetime.datetime.utcnow()
-        deleted = item.get('deleted', False) or False
+    Args:
+        results (list): List of results
+        source_name (str): Source name
+        cursor (psycopg2.Cursor): DB connection cursor
+        hashes (list, optional): The results content hashes. Defaults to None.
+        change_index (ChangeIndex, optional): Commits the hashes of the written results.
+            Defaults to None.
 
-        sql = "INSERT INTO rawitem (source, item_id, title, created_at, json, dataupdate_id, "\
-              "deleted) VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (source, item_id) "\
-              "DO UPDATE SET (created_at, title, json) = (EXCLUDED.created_at, EXCLUDED.title, EXCLUDED.json)"
+    Returns:
+        tuple: number of successfully written items, number of failed items
+    """
+    success = failures = 0
+    written = []
+    for index, item in enumerate(results):
         try:
-            cursor.execute(sql, (source_name, iid, title, created_at, Json(item), 1, deleted))
+            cursor.execute(UPSERT_SQL.format(values=ROW_TEMPLATE), item_to_row(item, source_name))
             cursor.execute('commit')
             success += 1
+            if hashes:
+                written.append(hashes[index])
         except Exception as e:
             LOG.error('Got error while inserting a line to DB')
             LOG.debug(e)
+            rollback(cursor)
             failures += 1
 
+    if change_index:
+        change_index.commit(source_name, written)
     return success, failures
 
 
+def apply_post_actions_batch(results_batch: Iterable, post_action_map: dict,
+                             pool: object = None) -> Iterable:
+    """Apply post actions batch
+    Applies post actions on every item of the batch (in place). With a pool, large batches are
+    processed by its worker processes, which return altered copies of the items.
+
+    Args:
+        results_batch (Iterable): Batch of items
+        post_action_map (dict): post action dict which maps fields to functions
+        pool (PostActionsPool, optional): Worker processes pool. Defaults to None.
+
+    Returns:
+        Iterable: the altered batch
+    """
+    if pool is not None and post_action_map['has_actions']:
+        return pool.apply(results_batch, post_action_map)
+
+    for result in results_batch:
+        try:
+            result = apply_post_actions(result, None, post_action_map)
+        except Exception as e:
+            LOG.error('Could not apply post action on item')
+            LOG.debug(e)
+
+    return results_batch
+
+
 def handle_results_batch(results_batch: Iterable, source_name: str, post_action_map: dict,
-                         cursor: object) -> tuple:
+                         cursor: object, write_mode: str = WRITE_MODE_ROW,
+                         loader: CopyLoader = None, pool: object = None,
+                         change_index: object = None) -> tuple:
     """Handle results batch
     Handles a batch of results. For each batch item, applies post actions and dumps item to db.
+    Both stages are timed in the run metrics.
     Args:
         results_batch (Iterable): [description]
         source_name (str): [description]
         post_action_map (dict): [description]
         cursor (psycopg2.connect.Cursor): DB connection cursor
+        write_mode (str, optional): One of WRITE_MODES. Defaults to WRITE_MODE_ROW.
+        loader (CopyLoader, optional): The source's bulk loader, used by WRITE_MODE_COPY.
+        pool (PostActionsPool, optional): Worker processes pool for the post actions.
+        change_index (ChangeIndex, optional): Skips the items which didn't change.
 
     Returns:
         tuple: number of successfully handled items, number of failed items
     """
 
-    for result in results_batch:
-        try:
-            result = apply_post_actions(result, None, post_action_map)
-        except Exception as e:
-            LOG.error('Could not apply post action on item')
-            LOG.debug(e)
+    with METRICS.timer('stage_seconds', source=source_name, stage=STAGE_POST_ACTIONS):
+        results_batch = apply_post_actions_batch(results_batch, post_action_map, pool)
+    with METRICS.timer('stage_seconds', source=source_name, stage=STAGE_WRITE):
+        return dump_results_to_db(results_batch, source_name, cursor, write_mode, loader,
+                                  change_index)
+
+
+def apply_deleted(items: dict, source: str, sql: str, cursor=None) -> bool:
+    """Apply Deleted
+    Copies the items deleted states into a temporary table and applies them to rawitem with
+    a single set based update, which only touches the rows whose state changes.
+
+    Args:
+        items (dict): Item ID -> deleted state
+        source (str): Name of current source
+        sql (str): The update statement (DELETED_SYNC_SQL or DELETED_UPDATE_SQL)
+        cursor (PooledCursor, optional): DB cursor. Defaults to the calling thread's cursor.
+
+    Returns:
+        bool: True if the update was committed
+    """
+    cursor = cursor or DBconnection().get_cursor()
+    try:
+        cursor.execute(DELETED_TABLE_SQL)
+        cursor.copy_expert(DELETED_COPY_SQL, CopyStream(items.items()))
+        cursor.execute(sql, {'source': source})
+        changes = [row[0] for row in cursor.fetchall()]
+        cursor.execute('commit')
+    except Exception as e:
+        LOG.error('Got error while updating deleted items')
+        LOG.debug(e)
+        rollback(cursor)
+        return False
 
-    return dump_results_to_db(results_batch, source_name, cursor)
+    LOG.info("Done Marking %s items as deleted, %s items as not deleted.",
+             changes.count(True), changes.count(False))
+    return True
 
 
-def set_deleted(items_id, source):
+def set_deleted(items_id, source, cursor=None):
     """Set Deleted
     Set the ids of all the items which are not in the received items list as deleted
 
     Args:
         items_id (list): List of al the ids of all the items which are not marked as deleted
         source (str): Name of current source
-    """
+        cursor (PooledCursor, optional): DB cursor. Defaults to the calling thread's cursor.
 
-    BATCH_SIZE = 100
-    cursor = DBconnection().get_cursor()
+    Returns:
+        bool: True if the update was committed
+    """
+    return apply_deleted({str(x): False for x in items_id}, source, DELETED_SYNC_SQL, cursor)
 
-    strsql = f"SELECT count(*) from rawitem WHERE source='{source}'"
-    cursor.execute(strsql)
-    total_deleted_items = cursor.fetchone()[0] - len(items_id)
 
-    strsql = f"UPDATE rawitem SET deleted=True WHERE source='{source}'"
-    cursor.execute(strsql)
+def update_deleted(items: dict, source, cursor=None):
+    """Update Deleted
+    Sets the deleted state of the received items only
 
-    for i in range(0, len(items_id), BATCH_SIZE):
-        batch = ','.join([f"'{str(x)}'" for x in items_id[i:i + BATCH_SIZE]])
-        strsql = f"UPDATE rawitem SET deleted=false WHERE item_id in ({batch}) "\
-                 f"AND source='{source}'"
-        cursor.execute(strsql)
+    Args:
+        items (dict): Item ID -> deleted state
+        source (str): Name of current source
+        cursor (PooledCursor, optional): DB cursor. Defaults to the calling thread's cursor.
 
-    LOG.info("Done Marking %s items as deleted.", total_deleted_items)
+    Returns:
+        bool: True if the update was committed
+    """
+    return apply_deleted({str(k): v for k, v in items.items()}, source, DELETED_UPDATE_SQL,
+                         cursor)
 
 
 class Singleton(type):
@@ -291,13 +772,213 @@ class Singleton(type):
         return cls._instances[cls]
 
 
-class DBconnection(metaclass=Singleton):
-    '''Singelton DB connection class'''
+class ConnectionPool():
+    '''Connection Pool
+    Thread safe pool of up to max_connections DB connections. Connections which were idle for
+    a while are health checked before they are handed out, and broken ones are replaced.
+    '''
+
+    def __init__(self, credentials: dict, max_connections: int = 1) -> None:
+        self._credentials = credentials
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle: list = []
+
+    def connect(self):
+        """Connect
+        Opens a new connection, retrying when the DB can't be reached
+        """
+        for attempt in range(DB_RETRIES + 1):
+            try:
+                return psycopg2.connect(**self._credentials)
+            except psycopg2.OperationalError as e:
+                if attempt == DB_RETRIES:
+                    raise
+                LOG.warning('Could not connect to target database, retrying')
+                LOG.debug(e)
+                time.sleep(DB_RETRY_DELAY * 2 ** attempt)
+
+    def getconn(self):
+        """Get connection
+        Returns a healthy connection, waiting for one to be returned if all are in use
+        """
+        if not self._slots.acquire(timeout=DB_CHECKOUT_TIMEOUT):
+            raise PoolError('No DB connection was returned to the pool in time')
 
-    def __init__(self, credentials) -> None:
         try:
-            self._conn = psycopg2.connect(**credentials)
-            self._cursor = self._conn.cursor()
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, returned_at = self._idle.pop()
+                if self._is_healthy(conn, returned_at):
+                    return conn
+                self._close(conn)
+            return self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """Put connection
+        Returns a connection to the pool, rolling back any open transaction
+        """
+        try:
+            if not conn.closed:
+                conn.rollback()
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        except Exception as e:
+            LOG.debug(e)
+            self._close(conn)
+        finally:
+            self._slots.release()
+
+    def reconnect(self, conn):
+        """Reconnect
+        Replaces a broken connection, keeping its pool slot
+        """
+        self._close(conn)
+        return self.connect()
+
+    def closeall(self):
+        """Close all
+        Closes the idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    @staticmethod
+    def _is_healthy(conn, returned_at: float) -> bool:
+        """Checks a connection with a ping if it was idle for DB_HEALTHCHECK_INTERVAL"""
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < DB_HEALTHCHECK_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception as e:
+            LOG.debug(e)
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception as e:
+            LOG.debug(e)
+
+
+class PooledCursor():
+    '''Pooled Cursor
+    Cursor of a pooled connection, which transparently reconnects when the connection drops.
+    A statement which fails on a dropped connection (or is chosen as a deadlock victim) is
+    retried when it is the first statement of its transaction, as nothing else was lost.
+    Otherwise the error is raised, for the caller to roll back and handle as before.
+    '''
+
+    def __init__(self, pool: ConnectionPool) -> None:
+        self._pool = pool
+        self._conn = pool.getconn()
+        self._cursor = self._conn.cursor()
+        self._in_transaction = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, sql, args=None):
+        """Executes a statement, reconnecting and retrying on transient errors"""
+        statement = sql.strip().lower() if isinstance(sql, str) else None
+        if statement in ('commit', 'rollback'):
+            return self._end_transaction(statement)
+
+        for attempt in range(DB_RETRIES + 1):
+            starts_transaction = not self._in_transaction
+            self._in_transaction = True
+            try:
+                return self._cursor.execute(sql, args)
+            except TRANSIENT_DB_ERRORS as e:
+                if self._conn.closed:
+                    self._reconnect()
+                elif isinstance(e, TransactionRollbackError):
+                    self._conn.rollback()
+                    self._in_transaction = False
+                else:
+                    raise
+
+                if not starts_transaction or attempt == DB_RETRIES:
+                    raise
+                LOG.warning('Got transient DB error, retrying statement')
+                LOG.debug(e)
+                time.sleep(DB_RETRY_DELAY * 2 ** attempt)
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        """Runs COPY, reconnecting if the connection dropped (the copy is not retried)"""
+        self._in_transaction = True
+        try:
+            return self._cursor.copy_expert(sql, file, *args, **kwargs)
+        except TRANSIENT_DB_ERRORS:
+            if self._conn.closed:
+                self._reconnect()
+            raise
+
+    def close(self):
+        """Closes the cursor and returns its connection to the pool"""
+        try:
+            self._cursor.close()
+        except Exception as e:
+            LOG.debug(e)
+        self._pool.putconn(self._conn)
+
+    def _end_transaction(self, statement: str):
+        """Commits or rolls back. A rollback of a dropped connection just reconnects."""
+        self._in_transaction = False
+        if self._conn.closed:
+            self._reconnect()
+            if statement == 'commit':
+                raise psycopg2.InterfaceError('Connection was lost before commit')
+            return
+
+        try:
+            return self._cursor.execute(statement)
+        except TRANSIENT_DB_ERRORS:
+            if self._conn.closed:
+                self._reconnect()
+            raise
+
+    def _reconnect(self):
+        LOG.warning('Lost connection to target database, reconnecting')
+        self._conn = self._pool.reconnect(self._conn)
+        self._cursor = self._conn.cursor()
+        self._in_transaction = False
+
+
+class DBconnection(metaclass=Singleton):
+    '''Singelton DB connection manager
+    Every thread gets its own PooledCursor, backed by a connection from a ConnectionPool. By
+    default the pool holds a single connection, used by the thread which creates the instance.
+
+    Created with a cursor instead of credentials, that cursor is handed out to every thread
+    and no connection is made (like the benchmark's stand-in cursor).
+    '''
+
+    def __init__(self, credentials: dict = None, max_connections: int = 1,
+                 cursor: object = None) -> None:
+        self._cursor = cursor
+        if cursor is not None:
+            return
+        if credentials is None:
+            raise RuntimeError('DBconnection must first be created with the Target credentials')
+
+        self._local = threading.local()
+        self._pool = ConnectionPool(credentials, max_connections)
+        try:
+            self.get_cursor()
         except Exception as e:
             LOG.error('Could not establish connection to target database!')
             LOG.debug(e)
@@ -305,6 +986,21 @@ class DBconnection(metaclass=Singleton):
 
     def get_cursor(self):
         """Get cursor
-        Returns psycopg2 connection cursor
+        Returns the PooledCursor of the calling thread
+        """
+        if self._cursor is not None:
+            return self._cursor
+        if getattr(self._local, 'cursor', None) is None:
+            self._local.cursor = PooledCursor(self._pool)
+        return self._local.cursor
+
+    def release(self):
+        """Release
+        Returns the connection of the calling thread to the pool
         """
-        return self._cursor
+        if self._cursor is not None:
+            return
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is not None:
+            self._local.cursor = None
+            cursor.close()